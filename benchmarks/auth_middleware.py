@@ -0,0 +1,91 @@
+"""
+Per-request overhead of the request middleware for an authenticated request with a warm identity cache,
+compared with the equivalent BaseHTTPMiddleware ("http" middleware) stack it replaced.
+No database is needed: the user is served from src.jwt.identity_cache and the session is never opened.
+
+python -m benchmarks.auth_middleware [requests]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+
+import config
+from src import middlewares, jwt
+from src.core import unit_of_work
+
+
+async def http_allow_credentials(request: Request, call_next):
+    response = await call_next(request)
+    origin = request.headers.get("origin")
+    if origin:
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+    return response
+
+
+async def http_check_auth(request: Request, call_next):
+    token = request.cookies.get('user_access_token')
+    if token:
+        result = await jwt.decode_jwt_token(token)
+        if type(result) != str:
+            request.state.user_id = result
+    return await call_next(request)
+
+
+async def http_session_per_request(request: Request, call_next):
+    async with unit_of_work() as uow:
+        response = await call_next(request)
+        if response.status_code < 500 and uow.is_active:
+            await uow.commit()
+        else:
+            await uow.rollback()
+    return response
+
+
+def build_app(stack: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/user/ping/')
+    async def ping(request: Request):
+        return {'user_id': getattr(request.state, 'user_id', None)}
+
+    if stack == 'http':
+        app.middleware("http")(http_allow_credentials)
+        app.middleware("http")(http_check_auth)
+        app.middleware("http")(http_session_per_request)
+    elif stack == 'asgi':
+        app.add_middleware(middlewares.RequestMiddleware)
+    return app
+
+
+async def measure(app: FastAPI, requests: int, cookies: dict) -> float:
+    transport = httpx.ASGITransport(app)
+    headers = {'origin': 'https://o6men.site'}
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', cookies=cookies, headers=headers) as client:
+        for _ in range(min(requests, 200)):
+            await client.get('/user/ping/')
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            await client.get('/user/ping/')
+        return (time.perf_counter() - start) / requests
+
+
+async def main(requests: int):
+    config.SECRET = config.SECRET or 'benchmark'
+    jwt.identity_cache.set(1, 1, ttl=3600)
+    cookies = {'user_access_token': jwt.create_jwt_token({'sub': '1'})}
+
+    bare = await measure(build_app('none'), requests, cookies)
+    print(f'requests: {requests}')
+    print(f'none  {bare * 1e6:8.1f} us/request')
+    for stack in ('http', 'asgi'):
+        wrapped = await measure(build_app(stack), requests, cookies)
+        print(f'{stack:5} {wrapped * 1e6:8.1f} us/request, middleware overhead {(wrapped - bare) * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
@@ -0,0 +1,85 @@
+"""
+Concurrent withdraw and topup writes that keep their transaction open for a while, like a request does until its
+response is sent. The statement triggers add every write to withdrawstatustotal and the volume rollups, whose rows
+stay locked until the writer commits: on a single row per group the writers would commit one after another,
+spread over shards they overlap.
+All writers insert a withdraw of the same status, bank and currency (then a topup, all in the current hour),
+wait `hold` seconds and commit. Prints the wall time next to the serialized one (writers * hold) and exits with 1
+when the writes mostly queued, or when withdrawstatustotal or the volume of the hour don't match the source afterwards.
+Needs the database from config with the migrations applied. The rows are marked like in benchmarks.plans
+(withdraws with tag 'benchmark', topups with a 'benchmark-' transaction hash) and are deleted again.
+
+python -m benchmarks.contention [writers] [hold]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import insert, select, func
+
+from benchmarks.plans import HASH_PREFIX, cleanup
+from benchmarks.search import TAG
+from src.core import UserCore, BankCore, CurrencyCore, WithdrawStatusTotalCore, WithdrawVolumeCore, TopUpVolumeCore, \
+    VolumeCore, read_from_primary, read_session, write_session
+from src.models import Withdraw, TopUp
+
+
+async def write(model, values: dict, hold: float):
+    async with write_session(model) as session:
+        await session.execute(insert(model).values(**values))
+        await asyncio.sleep(hold)
+
+
+async def run(name: str, model, values: dict, writers: int, hold: float) -> bool:
+    started = time.perf_counter()
+    await asyncio.gather(*[write(model, values, hold) for _ in range(writers)])
+    elapsed = time.perf_counter() - started
+    serialized = writers * hold
+    print(f'{name}: {writers} writers holding {hold:.2f}s: {elapsed:.2f}s, {serialized:.2f}s if serialized')
+    return elapsed <= serialized / 2
+
+
+async def volume_matches(core: VolumeCore, hour: datetime) -> bool:
+    # The hour's rollup rows summed over their shards against a recount of the source
+    rollup = await core.volume('hour', start=hour, end=hour + timedelta(hours=1))
+    async with read_session() as session:
+        actual = (await session.execute(
+            select(func.count()).where(core.source.datetime >= hour, core.source.datetime < hour + timedelta(hours=1))
+        )).scalar()
+    stored = sum(row.count for row in rollup)
+    print(f'{core.model.__tablename__}: {stored} rows in the hour, {actual} in {core.source.__tablename__}')
+    return stored == actual
+
+
+async def main(writers: int, hold: float) -> int:
+    read_from_primary()
+    user = await UserCore.find_one(columns=['id'])
+    bank = await BankCore.find_one(columns=['id'])
+    currency = await CurrencyCore.find_one(columns=['id'])
+    hour = datetime.now(UTC).replace(minute=0, second=0, microsecond=0)
+
+    results = []
+    try:
+        results.append(await run('withdraws', Withdraw, dict(
+            user_id=user.id, phone='+7 999 000-00-00', card='0000 0000 0000 0000', receiver='benchmark',
+            bank_id=bank.id, currency_id=currency.id, comment='', amount=1000, usdt_amount=10, tag=TAG,
+            status='waiting', pre_balance=0,
+        ), writers, hold))
+        results.append(await run('topups', TopUp, dict(
+            user_id=user.id, transaction_hash=f'{HASH_PREFIX}contention', usdt_amount=10, pre_balance=0,
+        ), writers, hold))
+        results.append(await volume_matches(WithdrawVolumeCore, hour))
+        results.append(await volume_matches(TopUpVolumeCore, hour))
+    finally:
+        await cleanup()
+
+    diff = await WithdrawStatusTotalCore.diff()
+    print(f'withdrawstatustotal: {len(diff)} groups differ from withdraw')
+    results.append(not diff)
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 10, float(args[1]) if len(args) > 1 else 0.5)))
@@ -0,0 +1,137 @@
+"""
+Query plan regression check for the withdraw/topup access paths: the whole /withdraws/ and /topups/ statements
+(page, totals and filtered summary CTEs, built by withdraw_list_statement/topup_list_statement like the endpoints do)
+for every filter and sort combination and the per-user lookups are EXPLAINed on a seeded table, and any sequential
+scan of withdraw or topup is reported. Exits with 1 when one is found.
+Needs the database from config with the migrations applied. Missing rows are added like in benchmarks.search
+(withdraws with tag 'benchmark', topups with a 'benchmark-' transaction hash), `--cleanup` deletes them again.
+
+python -m benchmarks.plans [rows] [--cleanup]
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+from itertools import product
+
+from sqlalchemy import select, delete, text
+
+from benchmarks.search import seed as seed_withdraws, cleanup as cleanup_withdraws
+from src.admin.router import withdraw_list_statement, topup_list_statement
+from src.admin.schemas import Withdraws, TopUps
+from src.core import UserCore, BankCore, TopUpCore, Explain, keyset, read_session, write_session
+from src.models import Withdraw, TopUp
+
+HASH_PREFIX = 'benchmark-'
+TABLES = ('withdraw', 'topup')
+
+now = datetime.now(UTC)
+WITHDRAW_FILTERS = [
+    {},
+    {'statuses': ['waiting']},
+    {'bank_ids': [1]},
+    {'statuses': ['waiting'], 'bank_ids': [1]},
+    {'start_date': now - timedelta(days=7), 'end_date': now},
+    {'statuses': ['completed'], 'start_date': now - timedelta(days=7)},
+    {'min_amount': 1000, 'max_amount': 1100},
+    {'min_usdt_amount': 10, 'max_usdt_amount': 11},
+    {'search': '1234 5678 9012 3456'},
+    {'search': '+7 999 123-45-67'},
+    {'search': 'перевод 17'},
+    {'search': '17'},
+]
+TOPUP_FILTERS = [
+    {},
+    {'start_date': now - timedelta(days=7), 'end_date': now},
+    {'min_usdt_amount': 10, 'max_usdt_amount': 11},
+    {'search': '4242'},
+    {'search': '17'},
+]
+SORTS = list(product(('datetime', 'id', 'amount'), ('desc', 'asc')))
+
+
+async def seed_topups(rows: int):
+    existing = await TopUpCore.count()
+    if existing >= rows:
+        return
+    user_ids = [row.id for row in await UserCore.find_all(columns=['id'])]
+
+    start = time.perf_counter()
+    for offset in range(existing, rows, 100000):
+        batch = min(100000, rows - offset)
+        await TopUpCore.add_many([
+            dict(
+                user_id=random.choice(user_ids),
+                transaction_hash=f'{HASH_PREFIX}{offset + i}',
+                usdt_amount=random.randint(10, 5000),
+                pre_balance=0,
+                datetime=now - timedelta(minutes=random.randint(0, 60 * 24 * 365)),
+            ) for i in range(batch)
+        ])
+        print(f'seeded {offset + batch}/{rows} topups, {time.perf_counter() - start:.1f}s')
+
+    async with write_session() as session:
+        await session.execute(text('ANALYZE topup'))
+
+
+def seq_scans(node: dict) -> set:
+    found = {node['Relation Name']} if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in TABLES \
+        else set()
+    for child in node.get('Plans', []):
+        found |= seq_scans(child)
+    return found
+
+
+async def check(name: str, query) -> bool:
+    async with read_session() as session:
+        plan = (await session.execute(Explain(query))).scalar()
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    scans = seq_scans(plan[0]['Plan'])
+    print(f'{"FAIL" if scans else "ok":4} {name}{"  seq scan on " + ", ".join(sorted(scans)) if scans else ""}')
+    return not scans
+
+
+async def main(rows: int) -> int:
+    await seed_withdraws(rows)
+    await seed_topups(rows)
+    bank = await BankCore.find_one()
+    user = await UserCore.find_one()
+
+    results = []
+    for filters, (sort_by, order) in product(WITHDRAW_FILTERS, SORTS):
+        if 'bank_ids' in filters:
+            filters = {**filters, 'bank_ids': [bank.id]}
+        statement, *_ = await withdraw_list_statement(Withdraws(**filters, sort_by=sort_by, order=order))
+        results.append(await check(f'withdraws {sort_by} {order} {filters}', statement))
+
+    for filters, (sort_by, order) in product(TOPUP_FILTERS, SORTS):
+        statement, *_ = await topup_list_statement(
+            TopUps(**filters, sort_by=sort_by, order=order), 'usdt_amount' if sort_by == 'amount' else sort_by
+        )
+        results.append(await check(f'topups {sort_by} {order} {filters}', statement))
+
+    # /user/stats/
+    for model in (Withdraw, TopUp):
+        query, _ = keyset(select(model).filter(model.user_id == user.id), model, 'datetime', 'desc', None)
+        results.append(await check(f'{model.__tablename__} of user {user.id}', query))
+
+    failed = results.count(False)
+    print(f'{len(results) - failed}/{len(results)} plans use indexes')
+    return 1 if failed else 0
+
+
+async def cleanup():
+    await cleanup_withdraws()
+    async with write_session(TopUp) as session:
+        result = await session.execute(delete(TopUp).where(TopUp.transaction_hash.startswith(HASH_PREFIX)))
+    print(f'deleted {result.rowcount} benchmark topups')
+
+
+if __name__ == '__main__':
+    if '--cleanup' in sys.argv:
+        asyncio.run(cleanup())
+    else:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        sys.exit(asyncio.run(main(int(args[0]) if args else 1000000)))
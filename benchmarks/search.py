@@ -0,0 +1,128 @@
+"""
+Admin withdraw search on a seeded table: the old OR of ILIKEs over casts and joined columns against src.admin.search.
+Needs the database from config with the migrations applied. Missing rows are added with tag 'benchmark',
+`--cleanup` deletes them again.
+
+python -m benchmarks.search [rows] [--cleanup]
+"""
+import asyncio
+import json
+import random
+import string
+import sys
+import time
+
+from sqlalchemy import select, or_, cast, String, func, text
+from sqlalchemy.dialects import postgresql
+
+from src.admin.search import withdraw_search
+from src.core import UserCore, BankCore, CurrencyCore, WithdrawCore, write_session
+from src.models import Withdraw, User, Bank, Currency
+
+TAG = 'benchmark'
+TERMS = ['1234 5678 9012 3456', '+7 999 123-45-67', '4242', 'иван', 'перевод 17', 'ab']
+WORDS = ['перевод', 'оплата', 'долг', 'аренда', 'подарок', 'иван', 'мария', 'сергей', 'ольга']
+
+
+def legacy_search(search: str):
+    search = search.lower()
+    return or_(
+        cast(Withdraw.id, String).ilike(f'%{search}%'),
+        cast(func.round(Withdraw.usdt_amount, 2), String).ilike(f'%{search}%'),
+        cast(func.round(Withdraw.amount, 2), String).ilike(f'%{search}%'),
+        func.to_char(Withdraw.datetime, 'YYYY-MM-DD HH24:MI:SS').ilike(f'%{search}%'),
+        cast(Withdraw.phone, String).ilike(f'%{search}%'),
+        cast(Withdraw.card, String).ilike(f'%{search}%'),
+        cast(Withdraw.comment, String).ilike(f'%{search}%'),
+        cast(Withdraw.tag, String).ilike(f'%{search}%'),
+        cast(Withdraw.receiver, String).ilike(f'%{search}%'),
+        User.tg_username.ilike(f'%{search}%'),
+        Bank.name.ilike(f'%{search}%'),
+        Currency.name.ilike(f'%{search}%'),
+        User.first_name.ilike(f'%{search}%'),
+    )
+
+
+def digits(n: int) -> str:
+    return ''.join(random.choices(string.digits, k=n))
+
+
+async def seed(rows: int):
+    existing = await WithdrawCore.count(tag=TAG)
+    if existing >= rows:
+        return
+    user_ids = [row.id for row in await UserCore.find_all(columns=['id'])]
+    bank_ids = [row.id for row in await BankCore.find_all(columns=['id'])]
+    currency_ids = [row.id for row in await CurrencyCore.find_all(columns=['id'])]
+
+    start = time.perf_counter()
+    for offset in range(existing, rows, 100000):
+        batch = min(100000, rows - offset)
+        await WithdrawCore.add_many([
+            dict(
+                user_id=random.choice(user_ids),
+                phone=f'+7 9{digits(2)} {digits(3)}-{digits(2)}-{digits(2)}',
+                card=' '.join(digits(4) for _ in range(4)),
+                receiver=random.choice(WORDS).capitalize(),
+                bank_id=random.choice(bank_ids),
+                currency_id=random.choice(currency_ids),
+                comment=f'{random.choice(WORDS)} {random.randint(1, 100)}',
+                amount=random.randint(1000, 500000),
+                usdt_amount=random.randint(10, 5000),
+                tag=TAG,
+                status=random.choice(['completed', 'waiting', 'reject', 'correction']),
+                pre_balance=0,
+            ) for _ in range(batch)
+        ])
+        print(f'seeded {offset + batch}/{rows} withdraws, {time.perf_counter() - start:.1f}s')
+
+    async with write_session() as session:
+        await session.execute(text('ANALYZE withdraw'))
+
+
+async def explain(condition) -> dict:
+    query = (
+        select(Withdraw.id)
+        .join(User, User.id == Withdraw.user_id)
+        .join(Bank, Bank.id == Withdraw.bank_id)
+        .join(Currency, Currency.id == Withdraw.currency_id)
+        .filter(condition)
+        .order_by(Withdraw.datetime.desc())
+        .limit(50)
+    )
+    # Literal values, so the plan is the one for this term and not a generic one
+    compiled = str(query.compile(dialect=postgresql.dialect(paramstyle='named'), compile_kwargs={'literal_binds': True}))
+    async with write_session() as session:
+        result = await session.execute(text('EXPLAIN (ANALYZE, FORMAT JSON) ' + compiled.replace(':', r'\:')))
+        plan = result.scalar()
+    return json.loads(plan)[0] if isinstance(plan, str) else plan[0]
+
+
+def scans(node: dict) -> set:
+    found = {f"{node['Node Type']} {node.get('Index Name', node.get('Relation Name', ''))}".strip()} \
+        if 'Scan' in node['Node Type'] else set()
+    for child in node.get('Plans', []):
+        found |= scans(child)
+    return found
+
+
+async def main(rows: int):
+    await seed(rows)
+    print(f'withdraws: {await WithdrawCore.count()}')
+    for term in TERMS:
+        for name, condition in (('legacy', legacy_search(term)), ('indexed', await withdraw_search(term))):
+            plan = await explain(condition)
+            withdraw_scans = sorted(scan for scan in scans(plan['Plan']) if 'withdraw' in scan)
+            print(f'{term!r:24} {name:8} {plan["Execution Time"]:10.2f} ms  {", ".join(withdraw_scans)}')
+
+
+async def cleanup():
+    print(f'deleted {await WithdrawCore.delete(tag=TAG)} benchmark withdraws')
+
+
+if __name__ == '__main__':
+    if '--cleanup' in sys.argv:
+        asyncio.run(cleanup())
+    else:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        asyncio.run(main(int(args[0]) if args else 1000000))
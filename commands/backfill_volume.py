@@ -0,0 +1,68 @@
+"""
+Recounts the hourly volume rollups (withdrawvolume, topupvolume) from withdraw and topup, one month per transaction,
+so writes to the source table only wait for the month being recounted.
+The migration fills the rollups and the triggers keep them up to date, this repairs them, e.g. after rows were
+changed with the triggers disabled. --since only recounts from that date on.
+
+python -m commands.backfill_volume [withdraws|topups] [--since YYYY-MM-DD]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+
+from src.core import WithdrawVolumeCore, TopUpVolumeCore
+
+CORES = {'withdraws': WithdrawVolumeCore, 'topups': TopUpVolumeCore}
+
+
+def utc(moment: datetime) -> datetime:
+    return moment.astimezone(UTC) if moment.tzinfo else moment.replace(tzinfo=UTC)
+
+
+def month_start(moment: datetime) -> datetime:
+    return utc(moment).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment: datetime) -> datetime:
+    return (moment + timedelta(days=32)).replace(day=1)
+
+
+async def backfill(name: str, since: datetime = None):
+    core = CORES[name]
+    first, last = await core.extent()
+    if first is None:
+        print(f'{name}: nothing to backfill')
+        return
+    first, last = utc(first), utc(last)
+    if since is not None:
+        first = max(first, since)
+
+    start = month_start(first)
+    rows = 0
+    while start <= last:
+        end = next_month(start)
+        started = time.perf_counter()
+        count = await core.rebuild(start, end)
+        rows += count
+        print(f'{name} {start:%Y-%m}: {count} rollup rows in {time.perf_counter() - started:.1f}s')
+        start = end
+    print(f'{name}: {rows} rollup rows')
+
+
+async def main(names, since: datetime = None):
+    for name in names:
+        await backfill(name, since)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    since = None
+    if '--since' in args:
+        index = args.index('--since')
+        since = datetime.fromisoformat(args[index + 1]).replace(tzinfo=UTC)
+        del args[index:index + 2]
+    unknown = set(args) - set(CORES)
+    if unknown:
+        sys.exit(f'Unknown rollups: {", ".join(sorted(unknown))}, expected {" or ".join(CORES)}')
+    asyncio.run(main(args or list(CORES), since))
@@ -0,0 +1,42 @@
+"""
+Picks the bcrypt cost factor for this host: the highest number of rounds whose hash still fits the target time.
+Put the result into BCRYPT_ROUNDS, existing hashes are upgraded on the next successful login.
+
+python -m commands.calibrate_bcrypt [target_ms] [samples]
+"""
+import sys
+import time
+
+from passlib.hash import bcrypt
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+
+
+def measure(rounds: int, samples: int) -> float:
+    hasher = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash('calibration password')
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main(target_ms: float, samples: int):
+    chosen = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        median = measure(rounds, samples) * 1000
+        print(f'rounds {rounds:2}: {median:8.1f} ms')
+        if median > target_ms:
+            break
+        chosen = rounds
+
+    print(f'target {target_ms:.0f} ms -> BCRYPT_ROUNDS={chosen}')
+
+
+if __name__ == '__main__':
+    main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 250,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
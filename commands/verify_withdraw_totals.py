@@ -0,0 +1,35 @@
+"""
+Recounts withdraw per status, bank and currency and diffs it against withdrawstatustotal.
+Exits with 1 when they differ, --fix rebuilds the table from the recount under a lock on withdraw.
+
+python -m commands.verify_withdraw_totals [--fix]
+"""
+import asyncio
+import sys
+
+from src.core import WithdrawStatusTotalCore
+
+
+async def main(fix: bool) -> int:
+    diff = await WithdrawStatusTotalCore.diff()
+    for row in diff:
+        print(
+            f'{row.status:<12} bank {row.bank_id:<5} currency {row.currency_id:<5} '
+            f'count {row.stored_count} != {row.actual_count}, '
+            f'amount {row.stored_amount} != {row.actual_amount}, '
+            f'usdt_amount {row.stored_usdt_amount} != {row.actual_usdt_amount}'
+        )
+    if not diff:
+        print('withdrawstatustotal is in sync')
+        return 0
+
+    print(f'{len(diff)} groups differ')
+    if not fix:
+        return 1
+
+    print(f'Rebuilt withdrawstatustotal: {await WithdrawStatusTotalCore.rebuild()} groups')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main('--fix' in sys.argv[1:])))
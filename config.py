@@ -13,19 +13,57 @@ DB_NAME = os.environ.get('DB_NAME')
 
 DB_URL = f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
+# Optional read replica, read-only Core queries are routed to it while it's healthy
+DB_REPLICA_HOST = os.environ.get('DB_REPLICA_HOST')
+DB_REPLICA_PORT = os.environ.get('DB_REPLICA_PORT', DB_PORT)
+
+DB_REPLICA_URL = f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_REPLICA_HOST}:{DB_REPLICA_PORT}/{DB_NAME}' \
+    if DB_REPLICA_HOST else None
+
+REPLICA_HEALTH_INTERVAL = 10 # seconds
+REPLICA_HEALTH_TIMEOUT = 2 # seconds
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 SECRET = os.environ.get('SECRET')
 
 TOKEN_LIFETIME = 12 # minutes
+SINGLE_USE_TG_TOKENS = os.environ.get('SINGLE_USE_TG_TOKENS', '0') == '1' # delete a tg auth token once it's exchanged for a cookie
+
+# Expired tg auth tokens are kept for a while so /auth/check_token/ can still say the token expired, then reaped
+TG_TOKEN_RETENTION = 60 # minutes after end_at
+TG_TOKEN_REAP_INTERVAL = 300 # seconds between sweeps
+TG_TOKEN_REAP_BATCH = 1000 # rows per DELETE, each batch is its own short transaction
+
+REFERENCE_TTL = 300 # seconds, currencies/banks/commission steps are served from memory for this long
+
+# Admin list responses are kept this long while none of the tables they're built from is written.
+# Writes made by other processes (other uvicorn workers, commands, manual SQL) show up after at most this long
+ADMIN_CACHE_TTL = int(os.environ.get('ADMIN_CACHE_TTL', 30)) # seconds, 0 turns the cache off
+ADMIN_CACHE_SIZE = 500 # responses, one per path and query string
+
+# count_mode=estimate on admin lists counts exactly when the planner expects fewer filtered rows than this
+COUNT_ESTIMATE_THRESHOLD = 10000
+
+IDENTITY_CACHE_TTL = 60 # seconds, how long a verified user id is trusted without checking user_table
+IDENTITY_CACHE_SIZE = 10000
+
+# bcrypt cost factor for new hashes, pick it with `python -m commands.calibrate_bcrypt`
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2)) # threads running bcrypt off the event loop
+
+# 'memory' keeps the buckets per worker process, 'postgres' shares them between workers through ratelimitbucket
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = 100000 # memory backend, least recently limited clients are forgotten first
+# Header with the client address set by the reverse proxy (e.g. X-Real-IP), the socket address is used when empty.
+# For a list like X-Forwarded-For the right-most address is taken, the one the proxy appended.
+# Behind a proxy the socket address is the proxy's unless uvicorn runs with --proxy-headers and trusts it
+# through --forwarded-allow-ips/FORWARDED_ALLOW_IPS set to the proxy address (see Dockerfile),
+# otherwise all clients share one bucket
+RATE_LIMIT_IP_HEADER = os.environ.get('RATE_LIMIT_IP_HEADER', '').lower()
 
 frontend_url = 'https://o6men.site/'
 
 CRYPTOADDRESS = 'TEDepUJidzXfCkHtDmWhAPQiTibhiRE2C5'
 
 ADMIN_TOKEN = '197685:DF3KijgREdqjzRFuylb0MTIh'
-
-BANKS = {
-    'tbank': 'ТБанк (Тинькофф)',
-    'sber': 'Сбер',
-    'alfa': 'Альфа'
-}
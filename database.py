@@ -1,7 +1,13 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncAttrs
+import asyncio
+import time
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncAttrs, AsyncEngine
 from sqlalchemy.orm import DeclarativeBase, declared_attr
 
-from config import DB_URL
+from config import DB_URL, DB_REPLICA_URL, REPLICA_HEALTH_INTERVAL, REPLICA_HEALTH_TIMEOUT
 
 engine = create_async_engine(DB_URL)
 
@@ -11,6 +17,107 @@ async_session_maker = async_sessionmaker(
     expire_on_commit=False,
 )
 
+replica_engine = create_async_engine(DB_REPLICA_URL) if DB_REPLICA_URL else None
+
+
+# SQLSTATEs of a replica that went away: connection exceptions and shutdown/startup of the server
+LOST_SQLSTATES = ('57P01', '57P02', '57P03')
+
+
+def replica_lost(err: Exception) -> bool:
+    # Only failures of the connection itself (refused, reset, invalidated by SQLAlchemy as a disconnect),
+    # errors of the query like a statement timeout or a recovery conflict go to the caller as they are
+    if isinstance(err, (OSError, TimeoutError)):
+        return True
+    if not isinstance(err, DBAPIError):
+        return False
+    sqlstate = getattr(err.orig, 'sqlstate', None) or ''
+    return err.connection_invalidated or sqlstate.startswith('08') or sqlstate in LOST_SQLSTATES
+
+
+# Session on the replica that doesn't wait for the next health check when the replica goes away:
+# the failed read marks it unhealthy and is run once more on the primary, like the later reads of the session
+class ReplicaSession(AsyncSession):
+    fallback: Optional[AsyncSession] = None
+
+    async def _retry(self, method: str, *args, **kwargs):
+        if self.fallback is None:
+            try:
+                return await getattr(super(), method)(*args, **kwargs)
+            except Exception as err:
+                if not replica_lost(err):
+                    raise
+                replica_health.mark_unhealthy()
+                self.fallback = async_session_maker()
+        return await getattr(self.fallback, method)(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._retry('execute', *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._retry('scalar', *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._retry('scalars', *args, **kwargs)
+
+    async def stream(self, *args, **kwargs):
+        # Only opening the cursor is retried, rows already handed out can't be taken back
+        return await self._retry('stream', *args, **kwargs)
+
+    async def close(self):
+        if self.fallback is not None:
+            await self.fallback.close()
+            self.fallback = None
+        await super().close()
+
+
+replica_session_maker = async_sessionmaker(
+    replica_engine,
+    class_=ReplicaSession,
+    expire_on_commit=False,
+) if replica_engine else None
+
+
+class ReplicaHealth:
+    def __init__(self, engine: Optional[AsyncEngine], interval: float, timeout: float):
+        self.engine = engine
+        self.interval = interval
+        self.timeout = timeout
+        self.healthy = engine is not None
+        self.checked_at = 0.0
+        self._checking = False
+
+    async def is_healthy(self) -> bool:
+        if self.engine is None:
+            return False
+        # Only one caller pings the replica, the rest keep using the last known state meanwhile
+        if not self._checking and time.monotonic() - self.checked_at >= self.interval:
+            self._checking = True
+            try:
+                await self.check()
+            finally:
+                self._checking = False
+        return self.healthy
+
+    async def check(self):
+        try:
+            async with asyncio.timeout(self.timeout):
+                async with self.engine.connect() as connection:
+                    await connection.execute(text('SELECT 1'))
+            self.healthy = True
+        except (OSError, TimeoutError, SQLAlchemyError):
+            self.healthy = False
+        self.checked_at = time.monotonic()
+
+    def mark_unhealthy(self):
+        # A failed read, the periodic check tries the replica again after interval
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+replica_health = ReplicaHealth(replica_engine, REPLICA_HEALTH_INTERVAL, REPLICA_HEALTH_TIMEOUT)
+
+
 class Base(AsyncAttrs, DeclarativeBase):
     __abstract__ = True
 
@@ -0,0 +1,94 @@
+import functools
+import hashlib
+import inspect
+import time
+from typing import Type, Callable, NamedTuple, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import config
+from database import Base
+from src.cache import TTLCache
+from src.core import table_versions, table_written_at, read_from_primary
+
+
+class CachedResponse(NamedTuple):
+    versions: Tuple[int, ...]
+    etag: str
+    body: bytes
+
+
+# Rendered GET responses keyed by path and normalized query string.
+# An entry is valid while the versions of the tables it was built from are the ones read before building it,
+# so a write committed by this process makes the next request rebuild it, and ttl bounds everything else.
+# Every worker process has its own entries and versions: a write made by another worker, a command or manual SQL
+# shows up after at most ttl (plus the replica lag when the rebuild reads from the replica).
+# Rebuilds within ttl of a write by this process read from the primary, a lagging replica would otherwise get its
+# old rows cached under the new versions.
+# The ETag is a hash of the body: If-None-Match gets a 304 straight from a valid entry, and after a rebuild
+# whenever the body came out the same
+class ResponseCache:
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.entries = TTLCache(ttl, maxsize)
+
+    @staticmethod
+    def key(request: Request) -> Tuple:
+        return request.url.path, tuple(sorted(request.query_params.multi_items()))
+
+    @staticmethod
+    def not_modified(request: Request, etag: str) -> bool:
+        if_none_match = request.headers.get('if-none-match')
+        if not if_none_match:
+            return False
+        return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    @staticmethod
+    def response(request: Request, entry: CachedResponse) -> Response:
+        headers = {'ETag': entry.etag, 'Cache-Control': 'private, no-cache'}
+        if ResponseCache.not_modified(request, entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type='application/json', headers=headers)
+
+    def __call__(self, *models: Type[Base]) -> Callable:
+        # Decorates a GET endpoint built from models, the endpoint gets the request as an extra keyword argument
+        tables = [model.__tablename__ for model in models]
+
+        def decorator(endpoint: Callable) -> Callable:
+            signature = inspect.signature(endpoint)
+
+            @functools.wraps(endpoint)
+            async def wrapper(*args, cache_request: Request, **kwargs):
+                if self.ttl <= 0:
+                    return await endpoint(*args, **kwargs)
+
+                key = self.key(cache_request)
+                # Read before building, so a write committed meanwhile leaves the entry already outdated
+                versions = tuple(table_versions[table] for table in tables)
+                entry = self.entries.get(key)
+                if entry is not None and entry.versions == versions:
+                    return self.response(cache_request, entry)
+
+                written_at = [table_written_at[table] for table in tables if table in table_written_at]
+                if written_at and time.monotonic() - max(written_at) < self.ttl:
+                    read_from_primary()
+                result = await endpoint(*args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+                body = JSONResponse(jsonable_encoder(result)).body
+                entry = CachedResponse(versions, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+                self.entries.set(key, entry)
+                return self.response(cache_request, entry)
+
+            wrapper.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter('cache_request', inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+            ])
+            return wrapper
+
+        return decorator
+
+
+cached = ResponseCache(config.ADMIN_CACHE_TTL, config.ADMIN_CACHE_SIZE)
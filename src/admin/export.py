@@ -0,0 +1,182 @@
+import csv
+import io
+import re
+import time
+import zipfile
+import zlib
+from datetime import datetime, UTC
+from decimal import Decimal
+from typing import AsyncIterator, Sequence, Any, Literal
+from xml.sax.saxutils import escape
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+
+from src.core import stream_rows
+
+CHUNK_SIZE = 64 * 1024
+
+# Control characters aren't allowed in XML 1.0 even escaped
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# A CSV cell starting with one of these is run as a formula by spreadsheet apps
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+# Collects what a writer produces until the generator hands it out, so nothing bigger than a chunk is kept.
+# It has no tell(), so zipfile writes entries for an unseekable stream (sizes go to data descriptors)
+class _Sink:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _text(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='seconds')
+    return str(value)
+
+
+def _csv_text(value: Any) -> str:
+    # Strings come from users (comments, names, ...), a leading quote keeps them text. Numbers stay as they are
+    text = _text(value)
+    if isinstance(value, str) and text.startswith(FORMULA_PREFIXES):
+        return "'" + text
+    return text
+
+
+async def csv_chunks(header: Sequence[str], rows: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    # BOM, so Excel opens the UTF-8 file with the right encoding
+    buffer.write('﻿')
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    async for row in rows:
+        writer.writerow([_csv_text(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _cell(value: Any) -> str:
+    if isinstance(value, bool) or value is None:
+        return '<c/>' if value is None else f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(XML_ILLEGAL.sub("", _text(value)))}</t></is></c>'
+
+
+def _xml_row(values: Sequence) -> str:
+    return '<row>' + ''.join(_cell(value) for value in values) + '</row>'
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Export" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+
+async def xlsx_chunks(header: Sequence[str], rows: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    # A minimal workbook with inline strings, so the sheet can be written row by row without a shared string table
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xml_row(header).encode())
+            async for row in rows:
+                sheet.write(_xml_row(row).encode())
+                if len(sink.buffer) >= CHUNK_SIZE:
+                    yield sink.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Row count and duration of every export, also when the client goes away before the end
+async def counted(rows: AsyncIterator[Sequence], name: str) -> AsyncIterator[Sequence]:
+    started = time.perf_counter()
+    count = 0
+    try:
+        async for row in rows:
+            count += 1
+            yield row
+    finally:
+        print(f'Export {name}: {count} rows in {time.perf_counter() - started:.1f}s')
+
+
+def export_response(name: str, header: Sequence[str], query: Select, format: Literal['csv', 'xlsx'],
+                    gzip: bool = False) -> StreamingResponse:
+    # Rows go from a server-side cursor straight into the response body, memory use doesn't depend on the row count
+    rows = counted(stream_rows(query), f'{name}.{format}{".gz" if gzip else ""}')
+    if format == 'csv':
+        chunks = csv_chunks(header, rows)
+        media_type = 'text/csv; charset=utf-8'
+    else:
+        chunks = xlsx_chunks(header, rows)
+        media_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    filename = f'{name}-{datetime.now(UTC):%Y%m%d-%H%M%S}.{format}'
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        media_type = 'application/gzip'
+        filename += '.gz'
+
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
@@ -0,0 +1,113 @@
+from typing import Type, Sequence, Tuple, Any, Optional, Literal
+
+from sqlalchemy import select, func, literal, true, null, JSON, Select
+from sqlalchemy.sql.elements import ColumnElement
+
+import config
+from database import Base
+from src.core import keyset, keyset_order, estimate_rows
+
+
+# Builds the one statement behind an admin list page:
+#
+#   WITH page AS (SELECT id, key, amounts, row_number() OVER (keyset order) FROM <filtered> <keyset> LIMIT n + 1),
+#        meta AS (SELECT <totals json>, <filtered json>, <page json>)
+#   SELECT meta.*, <entities> FROM meta LEFT JOIN page ON true LEFT JOIN <entities of page rows> ORDER BY page.rn
+#
+# Every summary is {key: {"count": ..., amount: ...}}, keyed by status for withdraws and by "all" for topups.
+# The meta row is there even when the page is empty, then the entity columns are all NULL
+class AdminList:
+    def __init__(self, model: Type[Base], joins: Sequence[Tuple[Any, ColumnElement]],
+                 amounts: Sequence[ColumnElement], key: ColumnElement = None):
+        self.model = model
+        self.joins = joins
+        self.amounts = amounts
+        # Ungrouped lists have a constant key, Postgres doesn't allow it in GROUP BY
+        self.grouped = key is not None
+        self.key = key if key is not None else literal('all')
+
+    def query(self) -> Select:
+        query = select(self.model, *[entity for entity, _ in self.joins])
+        for entity, onclause in self.joins:
+            query = query.join(entity, onclause)
+        return query
+
+    def summary(self, query: Select) -> Select:
+        # Groups the rows of query by key, for filtered queries built from self.query()
+        summary = query.with_only_columns(
+            self.key.label('key'),
+            func.count().label('count'),
+            *[func.coalesce(func.sum(amount), 0).label(amount.key) for amount in self.amounts],
+        ).order_by(None)
+        return summary.group_by(self.key) if self.grouped else summary
+
+    async def count_mode(self, query: Select, mode: Literal['exact', 'estimate', 'none']) -> Tuple[str, Optional[int]]:
+        # The mode to use and, for 'estimate', the planner's row count of query.
+        # Estimates below the threshold are cheap enough to count exactly
+        if mode != 'estimate':
+            return mode, None
+        estimate = await estimate_rows(query.with_only_columns(self.model.id).order_by(None))
+        if estimate < config.COUNT_ESTIMATE_THRESHOLD:
+            return 'exact', None
+        return 'estimate', estimate
+
+    def _json(self, summary: Select) -> ColumnElement:
+        # The first column of a summary is its key, whatever it's named
+        summary = summary.subquery()
+        fields = ['count'] + [amount.key for amount in self.amounts]
+        return select(
+            func.json_object_agg(
+                list(summary.c)[0],
+                func.json_build_object(*[part for field in fields for part in (literal(field), summary.c[field])]),
+                type_=JSON,
+            )
+        ).scalar_subquery()
+
+    def statement(self, query: Select, sort_by: str, order: str, cursor: Optional[str], page: int, limit: int,
+                  totals: Select, filtered: Select = None, count_filtered: bool = True) -> Tuple[Select, bool]:
+        # totals and filtered are summaries shaped like summary(): key, count, amounts.
+        # filtered defaults to summary(query), without count_filtered it's NULL and query is only scanned for the page.
+        # Raises ValueError for a broken cursor, like keyset()
+        rows, backwards = keyset(
+            query.with_only_columns(self.model.id, self.key.label('key'), *self.amounts),
+            self.model, sort_by, order, cursor,
+        )
+        rows = rows.add_columns(
+            func.row_number().over(order_by=keyset_order(self.model, sort_by, order, backwards)).label('rn')
+        )
+        offset = 0 if cursor else (page - 1) * limit
+        page_rows = rows.offset(offset).limit(limit + 1).cte('page')
+
+        # row_number() runs before OFFSET, so the page is offset + 1 .. offset + limit.
+        # The extra row only tells keyset_page whether there is more, it's not part of the page sums
+        page_summary = (
+            select(
+                page_rows.c.key,
+                func.count().label('count'),
+                *[func.coalesce(func.sum(page_rows.c[amount.key]), 0).label(amount.key) for amount in self.amounts],
+            )
+            .where(page_rows.c.rn <= offset + limit)
+            .group_by(page_rows.c.key)
+        )
+
+        meta = select(
+            self._json(totals).label('totals'),
+            (self._json(filtered if filtered is not None else self.summary(query)) if count_filtered
+             else null()).label('filtered'),
+            self._json(page_summary).label('page'),
+        ).cte('meta')
+
+        statement = (
+            select(meta.c.totals, meta.c.filtered, meta.c.page, self.model, *[entity for entity, _ in self.joins])
+            .select_from(meta)
+            .outerjoin(page_rows, true())
+            .outerjoin(self.model, self.model.id == page_rows.c.id)
+        )
+        for entity, onclause in self.joins:
+            statement = statement.outerjoin(entity, onclause)
+        return statement.order_by(page_rows.c.rn), backwards
+
+    @staticmethod
+    def split(rows: Sequence) -> Tuple[Any, list]:
+        # (meta row, entity tuples of the page rows)
+        return rows[0], [tuple(row[3:]) for row in rows if row[3] is not None]
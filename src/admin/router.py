@@ -4,19 +4,27 @@ import traceback
 
 import sqlalchemy.exc
 from PIL import Image
-from fastapi import APIRouter, Body, Response, Query, HTTPException, UploadFile
-from sqlalchemy import or_, cast, String, func
+from fastapi import APIRouter, Body, Response, Query, HTTPException, UploadFile, Depends
+from sqlalchemy import func
 from fastapi.responses import FileResponse
 
 from src import jwt
 from src.admin.schemas import *
 from src.core import *
 from src.models import *
+from src.reference import references
+from src.admin.search import withdraw_search, topup_search
+from src.admin.queries import AdminList
+from src.admin.export import export_response
+from src.admin.cache import cached
+from src.ratelimit import RateLimit
 
 router = APIRouter(prefix='', tags=['Админ панель'])
 
+auth_limit = RateLimit('admin_auth', rate=5, per=60)
 
-@router.post('/auth/')
+
+@router.post('/auth/', dependencies=[Depends(auth_limit)])
 async def auth(response: Response, token: str = Body(..., embed=True)):
     if token == config.ADMIN_TOKEN:
         admin_access_token = jwt.create_jwt_token({'sub': 'admin'})
@@ -32,69 +40,149 @@ async def check_auth():
     return {"ok": True, "result": "Authenticated"}
 
 
-@router.get('/withdraws/')
-async def withdraws(params: Annotated[Withdraws, Query()]) -> WithdrawsResponse:
-    page, limit, statuses, bank_ids, sort_by, order, search, start_date, end_date, min_amount, max_amount, min_usdt_amount, max_usdt_amount = (
-        params.page, params.limit, params.statuses, params.bank_ids, params.sort_by, params.order, params.search,
-        params.start_date, params.end_date, params.min_amount, params.max_amount, params.min_usdt_amount,
-        params.max_usdt_amount
-    )
+withdraw_list_query = AdminList(
+    Withdraw,
+    joins=(
+        (User, User.id == Withdraw.user_id),
+        (Bank, Bank.id == Withdraw.bank_id),
+        (Currency, Currency.id == Withdraw.currency_id),
+    ),
+    amounts=(Withdraw.amount, Withdraw.usdt_amount),
+    key=Withdraw.status,
+)
+
+topup_list_query = AdminList(
+    TopUp,
+    joins=((User, User.id == TopUp.user_id),),
+    amounts=(TopUp.usdt_amount,),
+)
 
-    query = (
-        select(
-            Withdraw,
-            User,
-            Bank,
-            Currency
-        )
-        .join(User, User.id == Withdraw.user_id)
-        .join(Bank, Bank.id == Withdraw.bank_id)
-        .join(Currency, Currency.id == Withdraw.currency_id)
-    )
-
-    if statuses:
-        query = query.filter(Withdraw.status.in_(statuses))
-
-    if bank_ids:
-        query = query.filter(Withdraw.bank_id.in_(bank_ids))
-
-    if search:
-        search = search.lower()
-        query = query.filter(
-            or_(
-                cast(Withdraw.id, String).ilike(f'%{search}%'),
-                cast(func.round(Withdraw.usdt_amount, 2), String).ilike(f'%{search}%'),
-                cast(func.round(Withdraw.amount, 2), String).ilike(f'%{search}%'),
-                func.to_char(Withdraw.datetime, 'YYYY-MM-DD HH24:MI:SS').ilike(f'%{search}%'),
-                cast(Withdraw.phone, String).ilike(f'%{search}%'),
-                cast(Withdraw.card, String).ilike(f'%{search}%'),
-                cast(Withdraw.comment, String).ilike(f'%{search}%'),
-                cast(Withdraw.tag, String).ilike(f'%{search}%'),
-                cast(Withdraw.receiver, String).ilike(f'%{search}%'),
-                User.tg_username.ilike(f'%{search}%'),
-                Bank.name.ilike(f'%{search}%'),
-                Currency.name.ilike(f'%{search}%'),
-                User.first_name.ilike(f'%{search}%'),
-            )
-        )
-
-    if start_date:
-        query = query.filter(cast(Withdraw.datetime, DateTime(timezone=True)) >= start_date)
-
-    if end_date:
-        query = query.filter(cast(Withdraw.datetime, DateTime(timezone=True)) <= end_date)
 
-    if min_amount:
-        query = query.filter(Withdraw.amount >= min_amount)
+async def filter_withdraws(query: Select, params: WithdrawFilters) -> Select:
+    if params.statuses:
+        query = query.filter(Withdraw.status.in_(params.statuses))
+
+    if params.bank_ids:
+        query = query.filter(Withdraw.bank_id.in_(params.bank_ids))
+
+    if params.search:
+        condition = await withdraw_search(params.search)
+        if condition is not None:
+            query = query.filter(condition)
+
+    if params.start_date:
+        query = query.filter(Withdraw.datetime >= params.start_date)
+
+    if params.end_date:
+        query = query.filter(Withdraw.datetime <= params.end_date)
+
+    if params.min_amount:
+        query = query.filter(Withdraw.amount >= params.min_amount)
+
+    if params.max_amount:
+        query = query.filter(Withdraw.amount <= params.max_amount)
+
+    if params.min_usdt_amount:
+        query = query.filter(Withdraw.usdt_amount >= params.min_usdt_amount)
+
+    if params.max_usdt_amount:
+        query = query.filter(Withdraw.usdt_amount <= params.max_usdt_amount)
+
+    return query
+
+
+async def filter_topups(query: Select, params: TopUpFilters) -> Select:
+    if params.search:
+        condition = await topup_search(params.search)
+        if condition is not None:
+            query = query.filter(condition)
+
+    if params.start_date:
+        query = query.filter(TopUp.datetime >= params.start_date)
+
+    if params.end_date:
+        query = query.filter(TopUp.datetime <= params.end_date)
+
+    if params.min_usdt_amount:
+        query = query.filter(TopUp.usdt_amount >= params.min_usdt_amount)
+
+    if params.max_usdt_amount:
+        query = query.filter(TopUp.usdt_amount <= params.max_usdt_amount)
+
+    return query
+
+
+withdraw_export_columns = (
+    ("id", Withdraw.id),
+    ("datetime", Withdraw.datetime),
+    ("status", Withdraw.status),
+    ("user_id", User.id),
+    ("tg_username", User.tg_username),
+    ("first_name", User.first_name),
+    ("bank", Bank.name),
+    ("currency", Currency.code),
+    ("amount", Withdraw.amount),
+    ("usdt_amount", Withdraw.usdt_amount),
+    ("phone", Withdraw.phone),
+    ("card", Withdraw.card),
+    ("receiver", Withdraw.receiver),
+    ("comment", Withdraw.comment),
+    ("tag", Withdraw.tag),
+)
+
+topup_export_columns = (
+    ("id", TopUp.id),
+    ("datetime", TopUp.datetime),
+    ("user_id", User.id),
+    ("tg_username", User.tg_username),
+    ("first_name", User.first_name),
+    ("transaction_hash", TopUp.transaction_hash),
+    ("usdt_amount", TopUp.usdt_amount),
+    ("pre_balance", TopUp.pre_balance),
+)
+
+
+def add_status_totals(meta_dict: dict, prefix: str, totals: dict | None):
+    for status, summary in (totals or {}).items():
+        if status not in meta_dict:
+            continue
+        for key in (status, "all"):
+            meta_dict[key][f"{prefix}_count"] += summary["count"]
+            meta_dict[key][f"{prefix}_amount"] += summary["amount"]
+            meta_dict[key][f"{prefix}_usdt_amount"] += summary["usdt_amount"]
+
+
+async def withdraw_list_statement(params: Withdraws) -> Tuple[Select, bool, str, Optional[int]]:
+    # The statement behind /withdraws/ (also EXPLAINed by benchmarks.plans) with its backwards flag, count mode
+    # and estimate. Raises ValueError for a broken cursor
+    query = await filter_withdraws(withdraw_list_query.query(), params)
+
+    # Totals come from the summary table, and so do filtered ones when only its dimensions are filtered,
+    # those are cheap enough to always be exact
+    filtered = None
+    count_mode, estimate = "exact", None
+    if not (params.search or params.start_date or params.end_date or params.min_amount or params.max_amount
+            or params.min_usdt_amount or params.max_usdt_amount):
+        filtered = WithdrawStatusTotalCore.totals_query(params.statuses, params.bank_ids)
+    else:
+        count_mode, estimate = await withdraw_list_query.count_mode(query, params.count_mode)
+
+    statement, backwards = withdraw_list_query.statement(
+        query, params.sort_by, params.order, params.cursor, params.page, params.limit,
+        totals=WithdrawStatusTotalCore.totals_query(), filtered=filtered, count_filtered=count_mode == "exact",
+    )
+    return statement, backwards, count_mode, estimate
 
-    if max_amount:
-        query = query.filter(Withdraw.amount <= max_amount)
 
-    if min_usdt_amount:
-        query = query.filter(Withdraw.usdt_amount >= min_usdt_amount)
+@router.get('/withdraws/')
+@cached(Withdraw, User, Bank, Currency, WithdrawStatusTotal)
+async def withdraws(params: Annotated[Withdraws, Query()]) -> WithdrawsResponse:
+    page, limit, sort_by, order = params.page, params.limit, params.sort_by, params.order
 
-    if max_usdt_amount:
-        query = query.filter(Withdraw.usdt_amount <= max_usdt_amount)
+    try:
+        statement, backwards, count_mode, estimate = await withdraw_list_statement(params)
+    except ValueError:
+        raise HTTPException(400, {"ok": False, "error": "Invalid cursor"})
 
     meta_dict = {
         "page": page,
@@ -119,98 +207,35 @@ async def withdraws(params: Annotated[Withdraws, Query()]) -> WithdrawsResponse:
             "total_filtered_usdt_amount": 0,
             "page_usdt_amount": 0,
         }
-    async with async_session_maker() as session:
-        filtered_subquery = query.subquery()
-        meta_filtered_result = await session.execute(select(
-            func.count().filter(filtered_subquery.c.status == "completed").label("completed_count"),
-            func.count().filter(filtered_subquery.c.status == "waiting").label("waiting_count"),
-            func.count().filter(filtered_subquery.c.status == "reject").label("reject_count"),
-            func.count().filter(filtered_subquery.c.status == "correction").label("correction_count"),
-
-            func.sum(filtered_subquery.c.usdt_amount).filter(filtered_subquery.c.status == "completed").label(
-                "completed_usdt_amount"),
-            func.sum(filtered_subquery.c.usdt_amount).filter(filtered_subquery.c.status == "waiting").label(
-                "waiting_usdt_amount"),
-            func.sum(filtered_subquery.c.usdt_amount).filter(filtered_subquery.c.status == "reject").label(
-                "reject_usdt_amount"),
-            func.sum(filtered_subquery.c.usdt_amount).filter(filtered_subquery.c.status == "correction").label(
-                "correction_usdt_amount"),
-
-            func.sum(filtered_subquery.c.amount).filter(filtered_subquery.c.status == "completed").label(
-                "completed_amount"),
-            func.sum(filtered_subquery.c.amount).filter(filtered_subquery.c.status == "waiting").label(
-                "waiting_amount"),
-            func.sum(filtered_subquery.c.amount).filter(filtered_subquery.c.status == "reject").label("reject_amount"),
-            func.sum(filtered_subquery.c.amount).filter(filtered_subquery.c.status == "correction").label(
-                "correction_amount"),
-
-            func.count().label("all_count"),
-            func.sum(filtered_subquery.c.amount).label("all_filtered_amount"),
-            func.sum(filtered_subquery.c.usdt_amount).label("all_filtered_usdt_amount"),
-        ))
 
-        total_meta_keys = meta_filtered_result.keys()
-        total_meta_values = meta_filtered_result.one()
-        for i, key in enumerate(total_meta_keys):
-            split = key.split("_")
-            type_ = split[0]
-            field = "total_filtered_" + (split[1] if len(split) == 2 else (split[1] + "_" + split[2]))
-            meta_dict[type_][field] = total_meta_values[i] if total_meta_values[i] else 0
-
-    meta_dict["pages_count"] = (meta_dict["all"]["total_filtered_count"] + limit - 1) // limit
-
-    if sort_by in ["datetime", "usdt_amount", "status", "amount", "id"]:
-        if order == "desc":
-            query = query.order_by(getattr(Withdraw, sort_by).desc())
-        else:
-            query = query.order_by(getattr(Withdraw, sort_by))
-
-    query = query.offset((page - 1) * limit).limit(limit)
-
-    async with async_session_maker() as session:
-        meta_result = await session.execute(
-            select(
-                func.count().filter(Withdraw.status == "completed").label("completed_count"),
-                func.count().filter(Withdraw.status == "waiting").label("waiting_count"),
-                func.count().filter(Withdraw.status == "reject").label("reject_count"),
-                func.count().filter(Withdraw.status == "correction").label("correction_count"),
-
-                func.sum(Withdraw.usdt_amount).filter(Withdraw.status == "completed").label("completed_usdt_amount"),
-                func.sum(Withdraw.usdt_amount).filter(Withdraw.status == "waiting").label("waiting_usdt_amount"),
-                func.sum(Withdraw.usdt_amount).filter(Withdraw.status == "reject").label("reject_usdt_amount"),
-                func.sum(Withdraw.usdt_amount).filter(Withdraw.status == "correction").label("correction_usdt_amount"),
-
-                func.sum(Withdraw.amount).filter(Withdraw.status == "completed").label("completed_amount"),
-                func.sum(Withdraw.amount).filter(Withdraw.status == "waiting").label("waiting_amount"),
-                func.sum(Withdraw.amount).filter(Withdraw.status == "reject").label("reject_amount"),
-                func.sum(Withdraw.amount).filter(Withdraw.status == "correction").label("correction_amount"),
-
-                func.count().label("all_count"),
-                func.sum(Withdraw.amount).label("all_amount"),
-                func.sum(Withdraw.usdt_amount).label("all_usdt_amount"),
-            )
-        )
-        total_meta_keys = meta_result.keys()
-        total_meta_values = meta_result.one()
-        for i, key in enumerate(total_meta_keys):
-            split = key.split("_")
-            type_ = split[0]
-            field = "total_" + (split[1] if len(split) == 2 else (split[1] + "_" + split[2]))
-            meta_dict[type_][field] = total_meta_values[i] if total_meta_values[i] else 0
+    async with read_session() as session:
+        result = await session.execute(statement)
+        meta, rows = withdraw_list_query.split(result.all())
+        withdraw_list, has_more = keyset_page(rows, limit, backwards)
 
-        result = await session.execute(query)
-        withdraw_list = result.all()
+    add_status_totals(meta_dict, "total", meta.totals)
+    add_status_totals(meta_dict, "page", meta.page)
+    if count_mode == "exact":
+        add_status_totals(meta_dict, "total_filtered", meta.filtered)
+        filtered_count = meta_dict["all"]["total_filtered_count"]
+    else:
+        for status in ("completed", "waiting", "reject", "correction", "all"):
+            for key in ("total_filtered_count", "total_filtered_amount", "total_filtered_usdt_amount"):
+                meta_dict[status][key] = None
+        # The planner can overshoot, the filtered rows are never more than all of them
+        filtered_count = estimate if estimate is None else min(estimate, meta_dict["all"]["total_count"])
+        meta_dict["all"]["total_filtered_count"] = filtered_count
+    meta_dict["pages_count"] = None if filtered_count is None else (filtered_count + limit - 1) // limit
+    meta_dict["count_mode"] = count_mode
+
+    meta_dict["next_cursor"], meta_dict["prev_cursor"] = keyset_cursors(
+        [row[0] for row in withdraw_list], sort_by, order, has_more, backwards,
+        from_start=not params.cursor and page == 1,
+    )
 
     response_withdraws = []
 
     for withdraw_row, user_row, bank_row, currency_row in withdraw_list:
-        meta_dict[withdraw_row.status]["page_count"] += 1
-        meta_dict[withdraw_row.status]["page_amount"] += withdraw_row.amount
-        meta_dict[withdraw_row.status]["page_usdt_amount"] += withdraw_row.usdt_amount
-        meta_dict["all"]["page_count"] += 1
-        meta_dict["all"]["page_amount"] += withdraw_row.amount
-        meta_dict["all"]["page_usdt_amount"] += withdraw_row.usdt_amount
-
         response_withdraws.append(WithdrawModel(
             user=UserModel(**user_row.__dict__),
             bank=BankModel(**bank_row.__dict__),
@@ -228,6 +253,15 @@ async def withdraws(params: Annotated[Withdraws, Query()]) -> WithdrawsResponse:
     return response
 
 
+@router.get('/withdraws/export/')
+async def withdraws_export(params: Annotated[WithdrawsExport, Query()]):
+    query = await filter_withdraws(withdraw_list_query.query(), params)
+    query = query.with_only_columns(*[column for _, column in withdraw_export_columns]).order_by(
+        *keyset_order(Withdraw, params.sort_by, params.order)
+    )
+    return export_response("withdraws", [name for name, _ in withdraw_export_columns], query, params.format, params.gzip)
+
+
 @router.get("/withdraw/{withdraw_id}/")
 async def withdraw(withdraw_id: int) -> WithdrawResponse:
     row = await WithdrawCore.find_one(id=withdraw_id)
@@ -323,94 +357,75 @@ async def withdraw_delete_document(withdraw_id: int) -> ResponseModel:
     return ResponseModel(result="Success")
 
 
-@router.get('/topups/')
-async def topups(params: Annotated[TopUps, Query()]):
-    page, limit, sort_by, order, search, start_date, end_date, min_usdt_amount, max_usdt_amount = (
-        params.page, params.limit, params.sort_by, params.order, params.search,
-        params.start_date, params.end_date, params.min_usdt_amount, params.max_usdt_amount
-    )
-
-    query = select(
-        TopUp,
-        User
-    ).join(
-        User, User.id == TopUp.user_id
-    )
+async def topup_list_statement(params: TopUps, sort_by: str) -> Tuple[Select, bool, str, Optional[int]]:
+    # Like withdraw_list_statement, sort_by already mapped to a TopUp column
+    query = await filter_topups(topup_list_query.query(), params)
 
-    if search:
-        search = search.lower()
-        query = query.filter(
-            or_(
-                cast(TopUp.id, String).ilike(f'%{search}%'),
-                cast(func.round(TopUp.usdt_amount, 2), String).ilike(f'%{search}%'),
-                func.to_char(TopUp.datetime, 'YYYY-MM-DD HH24:MI:SS').ilike(f'%{search}%'),
-                User.tg_username.ilike(f'%{search}%'),
-                User.first_name.ilike(f'%{search}%'),
-            )
-        )
+    # All-time totals are summed from the hourly rollup instead of scanning topup, unfiltered they are the filtered ones
+    totals = TopUpVolumeCore.totals_query()
+    filtered = None
+    count_mode, estimate = "exact", None
+    if not (params.search or params.start_date or params.end_date or params.min_usdt_amount
+            or params.max_usdt_amount):
+        filtered = totals
+    else:
+        count_mode, estimate = await topup_list_query.count_mode(query, params.count_mode)
 
-    if start_date:
-        query = query.filter(cast(TopUp.datetime, DateTime(timezone=True)) >= start_date)
+    statement, backwards = topup_list_query.statement(
+        query, sort_by, params.order, params.cursor, params.page, params.limit,
+        totals=totals, filtered=filtered, count_filtered=count_mode == "exact",
+    )
+    return statement, backwards, count_mode, estimate
 
-    if end_date:
-        query = query.filter(cast(TopUp.datetime, DateTime(timezone=True)) <= end_date)
 
-    if min_usdt_amount:
-        query = query.filter(TopUp.usdt_amount >= min_usdt_amount)
+@router.get('/topups/')
+@cached(TopUp, User, TopUpVolume)
+async def topups(params: Annotated[TopUps, Query()]):
+    page, limit, sort_by, order = params.page, params.limit, params.sort_by, params.order
 
-    if max_usdt_amount:
-        query = query.filter(TopUp.usdt_amount <= max_usdt_amount)
+    # TopUp only has a USDT amount
+    if sort_by == "amount":
+        sort_by = "usdt_amount"
 
+    try:
+        statement, backwards, count_mode, estimate = await topup_list_statement(params, sort_by)
+    except ValueError:
+        raise HTTPException(400, {"ok": False, "error": "Invalid cursor"})
+
+    async with read_session() as session:
+        result = await session.execute(statement)
+        meta, rows = topup_list_query.split(result.all())
+        topup_list, has_more = keyset_page(rows, limit, backwards)
+
+    empty = {"count": 0, "usdt_amount": 0}
+    total, total_filtered, page_total = [
+        (summary or {}).get("all", empty) for summary in (meta.totals, meta.filtered, meta.page)
+    ]
+    filtered_count = total_filtered["count"] if count_mode == "exact" else estimate
+    if count_mode == "estimate":
+        filtered_count = min(filtered_count, total["count"])
     meta_dict = {
         "page": page,
-        "pages_count": 0,
+        "pages_count": None if filtered_count is None else (filtered_count + limit - 1) // limit,
         "limit": limit,
-        "total_count": 0,
-        "total_filtered__count": 0,
-        "page_count": 0,
-        "total_usdt_amount": 0,
-        "total_filtered_usdt_amount": 0,
-        "page_usdt_amount": 0
+        "count_mode": count_mode,
+        "total_count": total["count"],
+        "total_filtered_count": filtered_count,
+        "page_count": page_total["count"],
+        "total_usdt_amount": total["usdt_amount"],
+        "total_filtered_usdt_amount": total_filtered["usdt_amount"] if count_mode == "exact" else None,
+        "page_usdt_amount": page_total["usdt_amount"],
     }
 
-    async with async_session_maker() as session:
-        filtered_subquery = query.subquery()
-
-        meta_dict["total_filtered_count"] = await session.scalar(
-            select(func.count()).select_from(filtered_subquery)
-        ) or 0
-
-        meta_dict["total_filtered_usdt_amount"] = await session.scalar(
-            select(func.sum(filtered_subquery.c.usdt_amount))
-        ) or 0
-
-    if sort_by in ["datetime", "usdt_amount", "id"]:
-        if order == "desc":
-            query = query.order_by(getattr(TopUp, sort_by).desc())
-        else:
-            query = query.order_by(getattr(TopUp, sort_by))
-
-    query = query.offset((page - 1) * limit).limit(limit)
-
-    async with async_session_maker() as session:
-        meta_dict["total_count"] = await session.scalar(select(func.count()).select_from(TopUp)) or 0
-        meta_dict["total_usdt_amount"] = await session.scalar(
-            select(func.sum(TopUp.usdt_amount)).select_from(TopUp)) or 0
-
-        result = await session.execute(query)
-        topup_list = result.all()
-
-    response_topups = []
-
-    meta_dict["pages_count"] = (meta_dict["total_filtered_count"] + limit - 1) // limit
+    meta_dict["next_cursor"], meta_dict["prev_cursor"] = keyset_cursors(
+        [row[0] for row in topup_list], sort_by, order, has_more, backwards,
+        from_start=not params.cursor and page == 1,
+    )
 
-    for topup_row, user_row in topup_list:
-        meta_dict["page_count"] += 1
-        meta_dict["page_usdt_amount"] += topup_row.usdt_amount
-        response_topups.append(TopUpModel(
-            user=UserModel(**user_row.__dict__),
-            **topup_row.__dict__
-        ))
+    response_topups = [
+        TopUpModel(user=UserModel(**user_row.__dict__), **topup_row.__dict__)
+        for topup_row, user_row in topup_list
+    ]
 
     response = TopUpsResponse(
         result=TopUpsResponse.Result(
@@ -422,10 +437,21 @@ async def topups(params: Annotated[TopUps, Query()]):
     return response
 
 
+
+@router.get('/topups/export/')
+async def topups_export(params: Annotated[TopUpsExport, Query()]):
+    query = await filter_topups(topup_list_query.query(), params)
+    sort_by = "usdt_amount" if params.sort_by == "amount" else params.sort_by
+    query = query.with_only_columns(*[column for _, column in topup_export_columns]).order_by(
+        *keyset_order(TopUp, sort_by, params.order)
+    )
+    return export_response("topups", [name for name, _ in topup_export_columns], query, params.format, params.gzip)
+
+
 @router.get("/topup/{topup_id}/")
 async def topup(topup_id: int) -> TopUpResponse:
     query = select(TopUp, User).join(User, User.id == TopUp.user_id).filter(TopUp.id == topup_id)
-    async with async_session_maker() as session:
+    async with read_session() as session:
         result = await session.execute(query)
         topup_row, user_row = result.first()
     if topup_row:
@@ -440,17 +466,23 @@ async def topup(topup_id: int) -> TopUpResponse:
 
 
 @router.get('/users/')
+@cached(User)
 async def users(ids: Annotated[List[int], Query(example=[1, 2])] = None):
-    async with async_session_maker() as session:
-        if not ids:
-            query = select(User).order_by(User.id.asc())
-        else:
-            query = select(User).filter(User.id.in_(ids)).order_by(User.id.asc())
-        result = await session.execute(query)
-        user_rows = result.scalars().all()
+    # Only the response fields, and without ids the table is read through a cursor instead of all at once
+    columns = list(UserModel.model_fields)
+    if not ids:
+        user_rows = [row async for row in UserCore.stream(columns=columns)]
+    else:
+        async with read_session() as session:
+            query = (
+                select(*[getattr(User, column) for column in columns])
+                .filter(User.id.in_(ids))
+                .order_by(User.id.asc())
+            )
+            user_rows = (await session.execute(query)).all()
 
     response = UsersResponse(
-        result=[UserModel(**row.__dict__) for row in user_rows]
+        result=[UserModel(**row._mapping) for row in user_rows]
     )
 
     return response
@@ -475,6 +507,7 @@ async def user_patch(user_id: int, data: UserPatch) -> UserResponse:
     if not data_to_update:
         raise HTTPException(400, {"ok": False, "error": "No parameters are passed"})
     updated_row = await UserCore.patch(user_id, **data_to_update)
+    jwt.invalidate_identity(user_id)
     if updated_row:
         return UserResponse(
             result=updated_row.__dict__
@@ -484,14 +517,9 @@ async def user_patch(user_id: int, data: UserPatch) -> UserResponse:
 
 
 @router.get('/currencies/')
+@cached(Currency)
 async def currencies(ids: Annotated[List[int], Query(example=[1, 2])] = None) -> CurrenciesResponse:
-    async with async_session_maker() as session:
-        if not ids:
-            query = select(Currency).order_by(Currency.id.asc())
-        else:
-            query = select(Currency).filter(Currency.id.in_(ids)).order_by(Currency.id.asc())
-        result = await session.execute(query)
-        currency_rows = result.scalars().all()
+    currency_rows = await references.currencies.all(ids)
 
     response = CurrenciesResponse(
         result=[CurrencyModel(**row.__dict__) for row in currency_rows]
@@ -502,7 +530,7 @@ async def currencies(ids: Annotated[List[int], Query(example=[1, 2])] = None) ->
 
 @router.get("/currency/{currency_id}/")
 async def currency_get(currency_id: int) -> CurrencyResponse:
-    row = await CurrencyCore.find_one(id=currency_id)
+    row = await references.currencies.get(id=currency_id)
     if row:
         return CurrencyResponse(
             result=row.__dict__
@@ -523,6 +551,7 @@ async def currency_post(input_currency: CurrencyPost) -> CurrencyResponse:
         )
     except sqlalchemy.exc.IntegrityError:
         raise HTTPException(400, {"ok": False, "error": "This name or code already exists"})
+    references.currencies.invalidate()
 
     currency_row = await CurrencyCore.find_one(id=new_row_id)
 
@@ -542,6 +571,7 @@ async def currency_post(currency_id: int, data: CurrencyPatch) -> CurrencyRespon
     if not data_to_update:
         raise HTTPException(400, {"ok": False, "error": "No parameters are passed"})
     updated_row = await CurrencyCore.patch(currency_id, **data_to_update)
+    references.currencies.invalidate()
     if updated_row:
         return CurrencyResponse(
             result=updated_row.__dict__
@@ -553,6 +583,7 @@ async def currency_post(currency_id: int, data: CurrencyPatch) -> CurrencyRespon
 @router.delete("/currency/{currency_id}/")
 async def currency_delete(currency_id: int) -> DeleteResponse:
     deleted_row = await CurrencyCore.delete(id=currency_id)
+    references.currencies.invalidate()
     if deleted_row:
         return DeleteResponse(ok=True, result=f"Currency {deleted_row} deleted successfully")
     else:
@@ -561,25 +592,25 @@ async def currency_delete(currency_id: int) -> DeleteResponse:
 
 @router.get("/currency/{currency_id}/commission_steps/")
 async def commissions_get(currency_id: int) -> CommissionStepsResponse:
-    currency = await CurrencyCore.find_one(id=currency_id)
+    currency = await references.currencies.get(id=currency_id)
     if not currency:
         raise HTTPException(404, {"ok": False, "error": "Currency not found"})
-    steps = await CommissionCore.find_all(currency_id=currency_id)
+    steps = await references.commission_steps.filter(currency_id=currency_id)
     return CommissionStepsResponse(result=[CommissionStepModel(**i.__dict__) for i in steps])
 
 
 @router.get("/commission_step/{commission_id}/")
 async def commission_get(commission_id: int) -> CommissionStepResponse:
-    commission_step = await CommissionCore.find_one(id=commission_id)
+    commission_step = await references.commission_steps.get(id=commission_id)
     if not commission_step:
         raise HTTPException(404, {"ok": False, "error": "Commission not found"})
-    step = await CommissionCore.find_one(id=commission_id)
-    return CommissionStepResponse(result=CommissionStepModel(**step.__dict__))
+    return CommissionStepResponse(result=CommissionStepModel(**commission_step.__dict__))
 
 
 @router.post("/currency/{currency_id}/commission_step/")
 async def commission_post(currency_id: int, input_c_step: CommissionStepPost) -> CommissionStepModel:
     new_row_id = await CommissionCore.add(**input_c_step.__dict__, currency_id=currency_id, currency_type="currency")
+    references.commission_steps.invalidate()
 
     commission_row = await CommissionCore.find_one(id=new_row_id)
 
@@ -591,19 +622,21 @@ async def commission_post(currency_id: int, input_c_step: CommissionStepPost) ->
 
 @router.patch("/commission_step/{commission_id}/")
 async def commissions_patch(commission_id: int, data: CommissionStepPatch) -> CommissionStepResponse:
-    commission_step = await CommissionCore.find_one(id=commission_id)
+    commission_step = await references.commission_steps.get(id=commission_id)
     if not commission_step:
         raise HTTPException(404, {"ok": False, "error": "Commission not found"})
     data_to_update = {}
     for k, v in data.model_dump(exclude_none=True).items():
         data_to_update[k] = v
     step = await CommissionCore.patch(id=commission_id, **data_to_update)
+    references.commission_steps.invalidate()
     return CommissionStepResponse(result=CommissionStepModel(**step.__dict__))
 
 
 @router.delete("commission_step/{commission_id}/")
 async def commissions_delete(commission_id: int) -> DeleteResponse:
     deleted_row = await CommissionCore.delete(id=commission_id)
+    references.commission_steps.invalidate()
     if deleted_row:
         return DeleteResponse(ok=True, result=f"Commission step {deleted_row} deleted successfully")
     else:
@@ -611,14 +644,9 @@ async def commissions_delete(commission_id: int) -> DeleteResponse:
 
 
 @router.get("/banks/")
+@cached(Bank)
 async def banks(ids: Annotated[List[int], Query(example=[1, 2])] = None):
-    async with async_session_maker() as session:
-        if not ids:
-            query = select(Bank).order_by(Bank.id.asc())
-        else:
-            query = select(Bank).filter(Bank.id.in_(ids)).order_by(Bank.id.asc())
-        result = await session.execute(query)
-        banks_rows = result.scalars().all()
+    banks_rows = await references.banks.all(ids)
 
     response = BanksResponse(
         result=[BankModel(**row.__dict__) for row in banks_rows]
@@ -629,7 +657,7 @@ async def banks(ids: Annotated[List[int], Query(example=[1, 2])] = None):
 
 @router.get("/bank/{bank_id}/")
 async def bank(bank_id: int) -> BankResponse:
-    row = await BankCore.find_one(id=bank_id)
+    row = await references.banks.get(id=bank_id)
     if row:
         return BankResponse(
             result=row.__dict__
@@ -647,6 +675,7 @@ async def bank_post(data: BankPost) -> BankResponse:
         )
     except sqlalchemy.exc.IntegrityError:
         raise HTTPException(400, {"ok": False, "error": "This name or code already exists"})
+    references.banks.invalidate()
 
     new_row = await BankCore.find_one(id=new_row_id)
 
@@ -666,6 +695,7 @@ async def bank_patch(bank_id: int, data: BankPatch) -> BankResponse:
     if not data_to_update:
         raise HTTPException(400, {"ok": False, "error": "No parameters are passed"})
     updated_row = await BankCore.patch(bank_id, **data_to_update)
+    references.banks.invalidate()
     if updated_row:
         return BankResponse(
             result=updated_row.__dict__
@@ -701,6 +731,7 @@ async def bank_post_icon(bank_id: int, file: UploadFile) -> BankResponse:
         resized_paths[f"{size}x{size}"] = resized_name
 
     bank_row = await BankCore.patch(bank_id, icon=resized_paths["64x64"])
+    references.banks.invalidate()
 
     return BankResponse(
         result=BankModel(**bank_row.__dict__)
@@ -710,6 +741,7 @@ async def bank_post_icon(bank_id: int, file: UploadFile) -> BankResponse:
 @router.delete("/bank/{bank_id}/")
 async def bank_delete(bank_id: int) -> DeleteResponse:
     deleted_row = await BankCore.delete(id=bank_id)
+    references.banks.invalidate()
     if deleted_row:
         return DeleteResponse(ok=True, result=f"Bank {deleted_row} deleted successfully")
     else:
@@ -725,6 +757,7 @@ async def bank_get_icon(bank_id: int) -> FileResponse:
         raise HTTPException(404, {"ok": False, "error": "Bank does not have a icon"})
     elif not os.path.exists("files/" + bank_row.icon):
         await BankCore.patch(id=bank_id, icon=None)
+        references.banks.invalidate()
         raise HTTPException(404, {"ok": False, "error": "Bank does not have a icon"})
 
     if not bank_row.icon:
@@ -742,7 +775,24 @@ async def bank_delete_icon(bank_id: int) -> ResponseModel:
         raise HTTPException(404, {"ok": False, "error": "Bank does not have a icon"})
 
     await BankCore.patch(id=bank_id, icon=None)
+    references.banks.invalidate()
     if os.path.exists("files/" + bank_row.icon):
         os.remove("files/" + bank_row.icon)
 
     return ResponseModel(result="Success")
+
+
+volume_groups = {"bank": "bank_id", "currency": "currency_id", "status": "status"}
+
+
+@router.get('/analytics/volume/')
+@cached(Withdraw, TopUp, WithdrawVolume, TopUpVolume)
+async def analytics_volume(params: Annotated[Volume, Query()]) -> VolumeResponse:
+    group_by = [volume_groups[group] for group in params.group_by.split(',')] if params.group_by else []
+    if params.source == "topups" and group_by:
+        raise HTTPException(400, {"ok": False, "error": "Topups can't be grouped"})
+
+    core = WithdrawVolumeCore if params.source == "withdraws" else TopUpVolumeCore
+    rows = await core.volume(params.bucket, group_by, params.start_date, params.end_date, params.timezone)
+
+    return VolumeResponse(result=[VolumeRow(**row._mapping) for row in rows])
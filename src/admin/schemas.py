@@ -1,5 +1,6 @@
 from datetime import datetime
 from typing import List, Literal
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from pydantic import BaseModel, Field, field_validator
 
@@ -162,15 +163,16 @@ class WithdrawModel(BaseModel):
             return False
 
 
-class Withdraws(BaseModel):
-    page: int = Field(1, ge=1)
-    limit: int = Field(50, ge=1)
+class WithdrawFilters(BaseModel):
     statuses: List[Literal["completed", "waiting", "reject", "correction"]] | None = None
     bank_ids: List[int] | None = None
     currencies: List[int] | None = None
     sort_by: Literal["id", "datetime", "amount"] = "datetime"
     order: Literal["asc", "desc"] = "desc"
-    search: str | None = None
+    search: str | None = Field(None, description="Card or phone number, id, user, bank or currency name, or from 3 "
+                                                 "characters on any part of the amounts, date, phone, card, comment, "
+                                                 "tag or receiver. Shorter numbers match ids and the whole part of "
+                                                 "amounts (17 finds 17.00-17.99), not dates")
     start_date: datetime | None = Field(None,
                                         description="Start date in ISO 8601 format with timezone YYYY-MM-DDThh:mm:ss(\"±hh:mm\" or \"Z\")")
     end_date: datetime | None = Field(None,
@@ -181,24 +183,44 @@ class Withdraws(BaseModel):
     max_usdt_amount: float | None = None
 
 
+class Withdraws(WithdrawFilters):
+    page: int = Field(1, ge=1)
+    limit: int = Field(50, ge=1)
+    cursor: str | None = Field(None, description="next_cursor/prev_cursor from a previous response, replaces page")
+    count_mode: Literal["exact", "estimate", "none"] = Field(
+        "exact", description="How total_filtered_count and pages_count are counted: exact, the planner's estimate "
+                             "(exact for small results) or not at all, e.g. for infinite scroll"
+    )
+
+
+class WithdrawsExport(WithdrawFilters):
+    format: Literal["csv", "xlsx"] = "csv"
+    gzip: bool = Field(False, description="Gzip the file, mostly useful for csv")
+
+
 class WithdrawsResponse(ResponseModel):
     class StatusSummary(BaseModel):
         total_count: int = Field(description="Общее количество элементов с этим статусом (без учёта фильтров)")
-        total_filtered_count: int = Field(description="Количество элементов с этим статусом (с учётом фильтров)")
+        total_filtered_count: int | None = Field(description="Количество элементов с этим статусом (с учётом фильтров), "
+                                                            "null если не считалось (count_mode)")
         page_count: int = Field(description="Количество элементов с этим статусом на текущей странице")
 
         total_amount: float = Field(description="Общая сумма для этого статуса (без учёта фильтров)")
-        total_filtered_amount: float = Field(description="Сумма для этого статуса (с учётом фильтров)")
+        total_filtered_amount: float | None = Field(description="Сумма для этого статуса (с учётом фильтров)")
         page_amount: float = Field(description="Сумма для этого статуса на текущей странице")
 
         total_usdt_amount: float = Field(description="Общая сумма в USDT для этого статуса (без учёта фильтров)")
-        total_filtered_usdt_amount: float = Field(description="Сумма в USDT для этого статуса (с учётом фильтров)")
+        total_filtered_usdt_amount: float | None = Field(description="Сумма в USDT для этого статуса (с учётом фильтров)")
         page_usdt_amount: float = Field(description="Сумма в USDT для этого статуса на текущей странице")
 
     class Meta(BaseModel):
         page: int = Field(description="Номер страницы")
-        pages_count: int = Field(description="Количество страниц (с учётом фильтров)")
+        pages_count: int | None = Field(description="Количество страниц (с учётом фильтров), null при count_mode=none")
         limit: int = Field(description="Количество элементов на странице")
+        count_mode: Literal["exact", "estimate", "none"] = Field(
+            "exact", description="Как посчитаны total_filtered_count и pages_count")
+        next_cursor: str | None = Field(None, description="Курсор следующей страницы")
+        prev_cursor: str | None = Field(None, description="Курсор предыдущей страницы")
         completed: "WithdrawsResponse.StatusSummary"
         waiting: "WithdrawsResponse.StatusSummary"
         reject: "WithdrawsResponse.StatusSummary"
@@ -238,12 +260,12 @@ class TopUpModel(BaseModel):
     usdt_amount: float
 
 
-class TopUps(BaseModel):
-    page: int = Field(1, ge=1)
-    limit: int = Field(50, ge=1)
+class TopUpFilters(BaseModel):
     sort_by: Literal["id", "datetime", "amount"] = "datetime"
     order: Literal["asc", "desc"] = "desc"
-    search: str | None = Field(None)
+    search: str | None = Field(None, description="Id, user name, or from 3 characters on any part of the id, amount "
+                                                 "or date. Shorter numbers match ids and the whole part of amounts "
+                                                 "(17 finds 17.00-17.99), not dates")
     start_date: datetime | None = Field(None,
                                         description="Start date in ISO 8601 format with timezone YYYY-MM-DDThh:mm:ss(\"±hh:mm\" or \"Z\")")
     end_date: datetime | None = Field(None,
@@ -252,16 +274,34 @@ class TopUps(BaseModel):
     max_usdt_amount: float | None = None
 
 
+class TopUps(TopUpFilters):
+    page: int = Field(1, ge=1)
+    limit: int = Field(50, ge=1)
+    cursor: str | None = Field(None, description="next_cursor/prev_cursor from a previous response, replaces page")
+    count_mode: Literal["exact", "estimate", "none"] = Field(
+        "exact", description="How total_filtered_count and pages_count are counted: exact, the planner's estimate "
+                             "(exact for small results) or not at all, e.g. for infinite scroll"
+    )
+
+
+class TopUpsExport(TopUpFilters):
+    format: Literal["csv", "xlsx"] = "csv"
+    gzip: bool = Field(False, description="Gzip the file, mostly useful for csv")
+
+
 class TopUpsResponse(ResponseModel):
     class Meta(BaseModel):
         page: int
-        pages_count: int
+        pages_count: int | None
         limit: int
+        count_mode: Literal["exact", "estimate", "none"] = "exact"
+        next_cursor: str | None = None
+        prev_cursor: str | None = None
         total_count: int
-        total_filtered_count: int
+        total_filtered_count: int | None
         page_count: int
         total_usdt_amount: float
-        total_filtered_usdt_amount: float
+        total_filtered_usdt_amount: float | None
         page_usdt_amount: float
 
     class Result(BaseModel):
@@ -273,3 +313,49 @@ class TopUpsResponse(ResponseModel):
 
 class TopUpResponse(ResponseModel):
     result: TopUpModel = None
+
+
+# analytics
+class Volume(BaseModel):
+    source: Literal["withdraws", "topups"] = "withdraws"
+    bucket: Literal["hour", "day", "month"] = "day"
+    group_by: str | None = Field(None, description="Comma separated bank, currency, status. Topups can't be grouped")
+    start_date: datetime | None = Field(None,
+                                        description="Start date in ISO 8601 format with timezone YYYY-MM-DDThh:mm:ss(\"±hh:mm\" or \"Z\")")
+    end_date: datetime | None = Field(None, description="Exclusive, same format as start_date")
+    timezone: str = Field("UTC", description="IANA time zone the day and month buckets start in, e.g. Europe/Moscow")
+
+    @field_validator('group_by')
+    def validate_group_by(cls, v):
+        if not v:
+            return None
+        groups = [group.strip() for group in v.split(',') if group.strip()]
+        unknown = set(groups) - {"bank", "currency", "status"}
+        if unknown:
+            raise ValueError(f"Unknown group_by: {', '.join(sorted(unknown))}")
+        return ','.join(dict.fromkeys(groups))
+
+    @field_validator('timezone')
+    def validate_timezone(cls, v):
+        # Postgres has its own zone database, this only turns typos into a 422 instead of a failed query
+        if v == "UTC":
+            return v
+        try:
+            ZoneInfo(v)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown timezone: {v}")
+        return v
+
+
+class VolumeRow(BaseModel):
+    bucket: datetime = Field(description="Начало периода")
+    status: str | None = None
+    bank_id: int | None = None
+    currency_id: int | None = None
+    count: int
+    amount: float | None = Field(None, description="Сумма в валюте вывода, только для withdraws")
+    usdt_amount: float
+
+
+class VolumeResponse(ResponseModel):
+    result: List[VolumeRow]
@@ -0,0 +1,99 @@
+import re
+from typing import Optional
+
+from sqlalchemy import or_, and_, select, Select
+from sqlalchemy.sql.elements import ColumnElement
+
+from src.models import Withdraw, TopUp, User
+from src.reference import references
+
+# pg_trgm can only use an index for patterns with at least one full trigram
+MIN_TRGM_LENGTH = 3
+MAX_ID = 2 ** 31 - 1
+
+CARD = re.compile(r'\d{4} ?\d{4} ?\d{4} ?\d{4}')
+PHONE = re.compile(r'\+?[78][\d\s()-]{10,}')
+
+
+def card_number(term: str) -> Optional[str]:
+    # Stored as "1234 5678 9012 3456"
+    if CARD.fullmatch(term):
+        digits = term.replace(' ', '')
+        return ' '.join(digits[i:i + 4] for i in range(0, 16, 4))
+
+
+def phone_number(term: str) -> Optional[str]:
+    # Stored as "+7 999 123-45-67"
+    if PHONE.fullmatch(term):
+        digits = re.sub(r'\D', '', term)
+        if len(digits) == 11:
+            return f'+7 {digits[1:4]} {digits[4:7]}-{digits[7:9]}-{digits[9:11]}'
+
+
+def whole_amount(column: ColumnElement, term: str) -> ColumnElement:
+    # A short number is taken as the whole part of an amount, "17" matches 17.00 to 17.99 through the btree on column
+    value = int(term)
+    return and_(column >= value, column < value + 1)
+
+
+def users_matching(term: str) -> Select:
+    # Served by the trigram indexes on user_table names, short terms scan user_table, which is far smaller than withdraw
+    return select(User.id).where(or_(User.tg_username.icontains(term, autoescape=True),
+                                     User.first_name.icontains(term, autoescape=True)))
+
+
+async def withdraw_search(term: str) -> Optional[ColumnElement]:
+    # Picks the cheapest condition for the shape of the term, every branch is backed by an index:
+    # card and phone numbers are exact btree lookups, a number is also tried as an id,
+    # anything long enough for a trigram goes to the GIN index on search_document,
+    # and user/bank/currency names are resolved on their own small tables before touching withdraw.
+    # Shorter terms can't use the trigram index and would match most documents anyway, so they only match ids, names
+    # and, for numbers, amounts with that whole part
+    term = term.strip().lower()
+    if not term:
+        return None
+
+    card = card_number(term)
+    if card:
+        return Withdraw.card == card
+    phone = phone_number(term)
+    if phone:
+        return Withdraw.phone == phone
+
+    conditions = []
+    if term.isdigit() and int(term) <= MAX_ID:
+        conditions.append(Withdraw.id == int(term))
+
+    if len(term) >= MIN_TRGM_LENGTH:
+        conditions.append(Withdraw.search_document.icontains(term, autoescape=True))
+    elif term.isdigit():
+        conditions += [whole_amount(Withdraw.amount, term), whole_amount(Withdraw.usdt_amount, term)]
+    conditions.append(Withdraw.user_id.in_(users_matching(term)))
+
+    if not term.isdigit():
+        bank_ids = [bank.id for bank in await references.banks.all() if term in bank.name.lower()]
+        currency_ids = [currency.id for currency in await references.currencies.all() if term in currency.name.lower()]
+        if bank_ids:
+            conditions.append(Withdraw.bank_id.in_(bank_ids))
+        if currency_ids:
+            conditions.append(Withdraw.currency_id.in_(currency_ids))
+
+    return or_(*conditions)
+
+
+async def topup_search(term: str) -> Optional[ColumnElement]:
+    term = term.strip().lower()
+    if not term:
+        return None
+
+    conditions = []
+    if term.isdigit() and int(term) <= MAX_ID:
+        conditions.append(TopUp.id == int(term))
+
+    if len(term) >= MIN_TRGM_LENGTH:
+        conditions.append(TopUp.search_document.icontains(term, autoescape=True))
+    elif term.isdigit():
+        conditions.append(whole_amount(TopUp.usdt_amount, term))
+    conditions.append(TopUp.user_id.in_(users_matching(term)))
+
+    return or_(*conditions)
@@ -1,16 +1,18 @@
 import re
-from datetime import UTC, datetime
 from typing import Literal, Union
 
-from fastapi import APIRouter, Response, Request, Body
+from fastapi import APIRouter, Response, Request, Body, Depends
 from pydantic import BaseModel
 
+import config
 from src import jwt
-from src.core import TgAuthTokenCore, UserCore
-from src.models import User
+from src.core import TgAuthTokenCore
+from src.ratelimit import RateLimit
 
 router = APIRouter(prefix='', tags=['Аутентификация/Авторизация'])
 
+check_token_limit = RateLimit('check_token', rate=10, per=60, burst=5)
+
 class LoginOptions(BaseModel):
     password: bool
     email: bool
@@ -46,33 +48,25 @@ async def check_auth(request: Request):
 
     return {'valid_auth': True, 'id': result}
 
-@router.post('/check_token/')
+@router.post('/check_token/', dependencies=[Depends(check_token_limit)])
 async def check_token(response: Response, token: str = Body(..., embed=True)):
-    db_token = await TgAuthTokenCore.find_one(token=token)
-    db_user = User
+    db_token = await TgAuthTokenCore.check(token, consume=config.SINGLE_USE_TG_TOKENS)
     if not db_token:
         answer = CheckToken(valid_token=False, info=check_errors(token) or 'not_exists')
+    elif not db_token.valid:
+        answer = CheckToken(valid_token=False, token_lifetime_expired=True)
     else:
-        login_options = None
-        if db_token.end_at < datetime.now(UTC):
-            valid_token = False
-            token_lifetime_expired = True
-        else:
-            valid_token = True
-            token_lifetime_expired = False
-            db_user = await UserCore.find_one(id=db_token.user_pk)
-            login_options = LoginOptions(
-                password = True if db_user.password else False,
-                email = True if db_user.email else False,
-                two_fa = db_user.two_fa,
-            )
         answer = CheckToken(
-            valid_token=valid_token,
-            token_lifetime_expired=token_lifetime_expired,
-            login_options=login_options,
+            valid_token=True,
+            token_lifetime_expired=False,
+            login_options=LoginOptions(
+                password=db_token.password,
+                email=db_token.email,
+                two_fa=db_token.two_fa,
+            ),
         )
 
     if answer.valid_token:
-        access_token = jwt.create_jwt_token({'sub': str(db_user.id)})
+        access_token = jwt.create_jwt_token({'sub': str(db_token.user_id)})
         response.set_cookie(key='user_access_token', value=access_token, httponly=True, samesite='lax', secure=False)
-    return answer
\ No newline at end of file
+    return answer
@@ -1,12 +1,330 @@
-from typing import Union, Type, Literal, List, Optional, Tuple
-
-from database import async_session_maker, Base
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.engine import Result
-from sqlalchemy import select, update, delete, asc, desc
-from sqlalchemy.exc import SQLAlchemyError
+import asyncio
+import base64
+import json
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, Context
+from datetime import datetime, timedelta, UTC
+from decimal import Decimal
+from typing import Union, Type, Literal, List, Optional, Tuple, AsyncIterator, Any, Sequence, Callable, Dict, Set
+
+from database import async_session_maker, replica_session_maker, replica_health, Base
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.engine import Result, Row
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy import select, update, delete, insert, asc, desc, func, tuple_, any_, bindparam, literal, cast, ARRAY, Numeric, \
+    Text, Select, and_, or_, text as sql_text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.util import AliasedClass
 from src.models import User, TgAuthToken, Withdraw, TopUp, ActiveApplication, Pattern, PatternField, Currency, File, \
-    Bank, CommissionStep
+    Bank, CommissionStep, BalanceLedger, RateLimitBucket, WithdrawStatusTotal, WithdrawVolume, TopUpVolume
+
+
+# One session/transaction shared by every Core call made inside a request.
+# The session is opened lazily, so requests that never touch the database don't check out a connection.
+class UnitOfWork:
+    def __init__(self):
+        self.session: Optional[AsyncSession] = None
+        self.read_session: Optional[AsyncSession] = None
+        self.commit_callbacks: List[Callable[[], Any]] = []
+
+    def get_session(self) -> AsyncSession:
+        if self.session is None:
+            self.session = async_session_maker()
+        return self.session
+
+    async def get_read_session(self) -> AsyncSession:
+        # Once the primary session is open, reads go through it to see the request's own writes
+        if self.session is not None or primary_reads.get():
+            return self.get_session()
+        if self.read_session is None:
+            maker = await read_session_maker()
+            if maker is async_session_maker:
+                return self.get_session()
+            self.read_session = maker()
+        return self.read_session
+
+    @property
+    def is_active(self) -> bool:
+        return self.session is None or self.session.is_active
+
+    async def commit(self):
+        if self.session is not None:
+            await self.session.commit()
+        for callback in self.commit_callbacks:
+            callback()
+        self.commit_callbacks.clear()
+
+    async def rollback(self):
+        if self.session is not None:
+            await self.session.rollback()
+        self.commit_callbacks.clear()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.read_session is not None:
+            await self.read_session.close()
+            self.read_session = None
+
+
+# add_many switches from a multi-row INSERT to COPY above this many rows
+COPY_THRESHOLD = 5000
+
+# Rows fetched per round trip by stream_rows
+STREAM_YIELD_PER = 1000
+
+current_uow: ContextVar[Optional[UnitOfWork]] = ContextVar('current_uow', default=None)
+
+# Committed writes per table made by this process, bumped by write_session(*models).
+# Cached responses built from a table are current as long as its version hasn't moved
+table_versions: Dict[str, int] = defaultdict(int)
+# time.monotonic() of the last bump per table, a replica may still lack the write for a while after it
+table_written_at: Dict[str, float] = {}
+
+# Set after the first write in the current request/task, so that it reads its own writes from the primary
+primary_reads: ContextVar[bool] = ContextVar('primary_reads', default=False)
+
+
+def read_from_primary():
+    primary_reads.set(True)
+
+
+def after_commit(callback: Callable[[], Any]):
+    # Outside a unit of work every write is already committed when its Core call returns
+    uow = current_uow.get()
+    if uow is None:
+        callback()
+    else:
+        uow.commit_callbacks.append(callback)
+
+
+async def read_session_maker() -> async_sessionmaker:
+    if replica_session_maker is not None and not primary_reads.get() and await replica_health.is_healthy():
+        return replica_session_maker
+    return async_session_maker
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[UnitOfWork]:
+    uow = UnitOfWork()
+    token = current_uow.set(uow)
+    try:
+        yield uow
+    except BaseException:
+        await uow.rollback()
+        raise
+    finally:
+        current_uow.reset(token)
+        await uow.close()
+
+
+@asynccontextmanager
+async def read_session() -> AsyncIterator[AsyncSession]:
+    uow = current_uow.get()
+    if uow is not None:
+        yield await uow.get_read_session()
+        return
+    async with (await read_session_maker())() as session:
+        yield session
+
+
+def bump_versions(*models: Type[Base]):
+    now = time.monotonic()
+    for model in models:
+        table_versions[model.__tablename__] += 1
+        table_written_at[model.__tablename__] = now
+
+
+@asynccontextmanager
+async def write_session(*models: Type[Base]) -> AsyncIterator[AsyncSession]:
+    # models are the tables the caller writes, their versions are bumped once the write is committed
+    read_from_primary()
+    uow = current_uow.get()
+    if uow is not None:
+        # Changes are flushed by the caller and committed once by the unit of work
+        yield uow.get_session()
+        if models:
+            after_commit(lambda: bump_versions(*models))
+        return
+    async with async_session_maker() as session:
+        async with session.begin():
+            yield session
+    bump_versions(*models)
+
+
+async def stream_rows(query: Select, yield_per: int = STREAM_YIELD_PER, scalars: bool = False) -> AsyncIterator[Any]:
+    # The server-side cursor holds its connection until the caller stops iterating,
+    # so it gets a session of its own instead of the request's one. That also keeps it usable
+    # from a response body, which is still being sent after the request's unit of work is closed
+    async with (await read_session_maker())() as session:
+        result = await session.stream(query.execution_options(yield_per=yield_per))
+        async for row in (result.scalars() if scalars else result):
+            yield row
+
+
+# EXPLAIN (FORMAT JSON) of a statement, with its parameters bound like in the statement itself
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement: Select):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element: Explain, compiler, **kw) -> str:
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+async def estimate_rows(query: Select) -> int:
+    # The planner's row estimate, from table statistics, nothing is executed
+    async with read_session() as session:
+        plan = (await session.execute(Explain(query))).scalar()
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def encode_cursor(order_by: str, order_type: Literal['asc', 'desc'], value: Any, id: int,
+                  direction: Literal['next', 'prev'] = 'next') -> str:
+    # The sort is part of the cursor, a cursor of one sort means nothing in another
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, Decimal):
+        value = str(value)
+    payload = json.dumps([order_by, order_type, value, id, direction], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, column, order_by: str,
+                  order_type: Literal['asc', 'desc']) -> Tuple[Any, int, Literal['next', 'prev']]:
+    # Anything malformed is a ValueError, which the endpoints turn into a 400
+    try:
+        cursor_order_by, cursor_order_type, value, id, direction = json.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        )
+        if (cursor_order_by, cursor_order_type) != (order_by, order_type) or direction not in ('next', 'prev'):
+            raise ValueError('Cursor of another sort')
+
+        python_type = column.type.python_type
+        if python_type is datetime:
+            value = datetime.fromisoformat(value)
+        elif value is not None:
+            value = python_type(value)
+        return value, int(id), direction
+    except (TypeError, ValueError, ArithmeticError) as err:
+        raise ValueError('Invalid cursor') from err
+
+
+def keyset(query: Select, model: Type[Base], order_by: str, order_type: Literal['asc', 'desc'] = 'asc',
+           cursor: str = None) -> Tuple[Select, bool]:
+    # Orders the query by (order_by, id) and continues it after the row encoded in the cursor.
+    # A 'prev' cursor scans backwards, so its rows come out reversed (see keyset_page)
+    column = getattr(model, order_by)
+    backwards = False
+
+    if cursor:
+        value, id, direction = decode_cursor(cursor, column, order_by, order_type)
+        backwards = direction == 'prev'
+        left, right = (model.id, id) if column is model.id else (tuple_(column, model.id), tuple_(value, id))
+        if (order_type == 'desc') != backwards:
+            query = query.filter(left < right)
+        else:
+            query = query.filter(left > right)
+
+    return query.order_by(*keyset_order(model, order_by, order_type, backwards)), backwards
+
+
+def keyset_order(model: Type[Base], order_by: str, order_type: Literal['asc', 'desc'] = 'asc',
+                 backwards: bool = False) -> list:
+    column = getattr(model, order_by)
+    order: Union[asc, desc] = desc if (order_type == 'desc') != backwards else asc
+    if column is model.id:
+        return [order(column)]
+    return [order(column), order(model.id)]
+
+
+def keyset_page(rows: list, limit: int, backwards: bool) -> Tuple[list, bool]:
+    # The query is expected to fetch limit + 1 rows, the extra one only tells whether there is more
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if backwards:
+        rows.reverse()
+    return rows, has_more
+
+
+def keyset_cursors(rows: list, order_by: str, order_type: Literal['asc', 'desc'], has_more: bool, backwards: bool,
+                   from_start: bool) -> Tuple[Optional[str], Optional[str]]:
+    if not rows:
+        return None, None
+
+    first, last = rows[0], rows[-1]
+    more_after = True if backwards else has_more
+    more_before = has_more if backwards else not from_start
+
+    next_cursor = encode_cursor(order_by, order_type, getattr(last, order_by), last.id, 'next') if more_after else None
+    prev_cursor = encode_cursor(order_by, order_type, getattr(first, order_by), first.id, 'prev') \
+        if more_before else None
+    return next_cursor, prev_cursor
+
+
+# Coalesces by-key lookups issued in the same event-loop tick into one `WHERE key = ANY(:keys)` query
+class BatchLoader:
+    def __init__(self, model: Type[Base], key: str, columns: Sequence[str] = None):
+        self.model = model
+        self.key = key
+        self.columns = [key, *(c for c in columns if c != key)] if columns else None
+        self.pending: Dict[Any, List[asyncio.Future]] = {}
+        self.scheduled = False
+        # The event loop only keeps weak references to tasks, a running fetch must not be garbage collected
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def load(self, value: Any) -> Optional[Union[Base, Row]]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(value, []).append(future)
+        if not self.scheduled:
+            self.scheduled = True
+            # An empty context keeps the batch off whichever request happened to schedule it
+            loop.call_soon(self._dispatch, context=Context())
+        return await future
+
+    def _dispatch(self):
+        pending, self.pending, self.scheduled = self.pending, {}, False
+        task = asyncio.create_task(self._fetch(pending))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _fetch(self, pending: Dict[Any, List[asyncio.Future]]):
+        column = getattr(self.model, self.key)
+        if self.columns:
+            query = select(*[getattr(self.model, c) for c in self.columns])
+        else:
+            query = select(self.model)
+        query = query.filter(column == any_(bindparam('keys', list(pending), type_=ARRAY(column.type))))
+
+        try:
+            async with read_session() as session:
+                res = await session.execute(query)
+                rows = res.all() if self.columns else res.scalars().all()
+        except Exception as err:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(err)
+            return
+
+        found = {getattr(row, self.key): row for row in rows}
+        for value, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(found.get(value))
+
+
+_loaders: Dict[Tuple[Type[Base], str, Tuple[str, ...]], BatchLoader] = {}
 
 
 class BaseCore:
@@ -14,34 +332,55 @@ class BaseCore:
 
     @staticmethod
     async def execute(query) -> Result:
-        async with async_session_maker() as session:
+        async with read_session() as session:
             session: AsyncSession
             result: Result = await session.execute(query)
             return result
 
     @classmethod
-    async def find_all(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', limit: int = None, **filter_by) -> List[model]:
-        order_type: Union[asc, desc] = asc if order_type == 'asc' else desc
+    def _select(cls, columns: Sequence[str] = None) -> Select:
+        # With columns only those are fetched, as plain named rows instead of identity-mapped entities
+        if columns:
+            return select(*[getattr(cls.model, column) for column in columns])
+        return select(cls.model)
+
+    @classmethod
+    async def load(cls, value: Any, key: str = 'id', columns: Sequence[str] = None) -> Optional[Union[model, Row]]:
+        # After a write the batch (which runs on its own session) could miss it, so look it up directly
+        uow = current_uow.get()
+        if primary_reads.get() or (uow is not None and uow.session is not None):
+            return await cls.find_one(columns=columns, **{key: value})
+
+        loader_key = (cls.model, key, tuple(columns or ()))
+        loader = _loaders.get(loader_key)
+        if loader is None:
+            loader = _loaders[loader_key] = BatchLoader(cls.model, key, columns)
+        return await loader.load(value)
 
-        async with async_session_maker() as session:
-            query = select(cls.model)
+    @classmethod
+    async def find_all(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', limit: int = None,
+                       after: str = None, columns: Sequence[str] = None, **filter_by) -> List[Union[model, Row]]:
+        async with read_session() as session:
+            query = cls._select(columns)
 
             for field, value in filter_by.items():
                 query = query.filter(getattr(cls.model, field) == value)
 
-            query = query.order_by(order_type(getattr(cls.model, order_by)))
+            query, backwards = keyset(query, cls.model, order_by, order_type, after)
 
             query = query.limit(limit)
 
             res = await session.execute(query)
-            return res.scalars().all()
+            rows = res.all() if columns else res.scalars().all()
+            return rows[::-1] if backwards else rows
 
     @classmethod
-    async def find_one(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', **filter_by) -> Optional[model]:
+    async def find_one(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', columns: Sequence[str] = None,
+                       **filter_by) -> Optional[Union[model, Row]]:
         order_type: Union[asc, desc] = asc if order_type == 'asc' else desc
 
-        async with async_session_maker() as session:
-            query = select(cls.model)
+        async with read_session() as session:
+            query = cls._select(columns)
 
             for field, value in filter_by.items():
                 query = query.filter(getattr(cls.model, field) == value)
@@ -51,93 +390,278 @@ class BaseCore:
             query = query.limit(1)
 
             res = await session.execute(query)
-            return res.scalars().one_or_none()
+            return res.first() if columns else res.scalars().one_or_none()
+
+    @classmethod
+    async def stream(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', yield_per: int = STREAM_YIELD_PER,
+                     columns: Sequence[str] = None, **filter_by) -> AsyncIterator[Union[model, Row]]:
+        # Like find_all without a limit, but rows come from a server-side cursor yield_per at a time
+        order_type: Union[asc, desc] = asc if order_type == 'asc' else desc
+
+        query = cls._select(columns)
+
+        for field, value in filter_by.items():
+            query = query.filter(getattr(cls.model, field) == value)
+
+        query = query.order_by(order_type(getattr(cls.model, order_by)))
+
+        async for row in stream_rows(query, yield_per, scalars=not columns):
+            yield row
+
+    @classmethod
+    async def count(cls, **filter_by) -> int:
+        async with read_session() as session:
+            query = select(func.count()).select_from(cls.model)
+
+            for field, value in filter_by.items():
+                query = query.filter(getattr(cls.model, field) == value)
+
+            return await session.scalar(query)
 
     @classmethod
     async def add(cls, **values) -> int:
-        async with async_session_maker() as session:
-            async with session.begin():
-                new = cls.model(**values)
-                session.add(new)
-                try:
-                    await session.commit()
-                    return new.id
-                except SQLAlchemyError as err:
-                    await session.rollback()
-                    raise err
+        async with write_session(cls.model) as session:
+            new = cls.model(**values)
+            session.add(new)
+            await session.flush()
+            return new.id
+
+    @classmethod
+    async def add_many(cls, rows: List[dict]) -> List[int]:
+        # Ids are returned in the same order as rows, so callers can link child rows to them
+        if not rows:
+            return []
+
+        async with write_session(cls.model) as session:
+            if len(rows) >= COPY_THRESHOLD:
+                return await cls._copy_many(session, rows)
+
+            result = await session.execute(
+                insert(cls.model).returning(cls.model.id, sort_by_parameter_order=True),
+                rows,
+            )
+            return list(result.scalars().all())
+
+    @classmethod
+    async def _copy_many(cls, session: AsyncSession, rows: List[dict]) -> List[int]:
+        table = cls.model.__table__
+
+        # COPY can't return generated keys, so the ids are reserved from the sequence up front
+        result = await session.execute(
+            select(func.nextval(func.pg_get_serial_sequence(table.name, 'id')))
+            .select_from(func.generate_series(1, len(rows)))
+        )
+        ids = sorted(result.scalars().all())
+
+        keys = set().union(*rows)
+        columns = [c for c in table.columns if c.name in keys or c.name == 'id' or c.default is not None]
+
+        records = []
+        for id_, row in zip(ids, rows):
+            record = []
+            for column in columns:
+                if column.name == 'id':
+                    record.append(id_)
+                elif column.name in row:
+                    record.append(row[column.name])
+                elif column.default is not None and column.default.is_scalar:
+                    record.append(column.default.arg)
+                elif column.default is not None and column.default.is_callable:
+                    record.append(column.default.arg(None))
+                else:
+                    record.append(None)
+            records.append(tuple(record))
+
+        connection = await session.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            table.name,
+            records=records,
+            columns=[c.name for c in columns],
+        )
+        return ids
+
+    @classmethod
+    async def upsert(cls, conflict_cols: Sequence[str], update_cols: Sequence[str] = (), **values) -> Optional[model]:
+        # INSERT ... ON CONFLICT DO UPDATE (DO NOTHING without update_cols, then None is returned on conflict)
+        rows = await cls.upsert_many(conflict_cols, update_cols, [values])
+        return rows[0] if rows else None
+
+    @classmethod
+    async def upsert_many(cls, conflict_cols: Sequence[str], update_cols: Sequence[str] = (),
+                          rows: List[dict] = ()) -> List[model]:
+        # Returns the inserted/updated rows, rows skipped by DO NOTHING are left out
+        if not rows:
+            return []
+
+        query = pg_insert(cls.model).values(list(rows))
+        if update_cols:
+            query = query.on_conflict_do_update(
+                index_elements=conflict_cols,
+                set_={column: query.excluded[column] for column in update_cols},
+            )
+        else:
+            query = query.on_conflict_do_nothing(index_elements=conflict_cols)
+        query = query.returning(cls.model).execution_options(populate_existing=True)
+
+        async with write_session(cls.model) as session:
+            res = await session.execute(query)
+            return list(res.scalars().all())
 
     @classmethod
     async def update(cls, filter_by, **values) -> int:
-        async with async_session_maker() as session:
-            async with session.begin():
-                query = (
-                    update(cls.model)
-                    .where(*[getattr(cls.model, k) == v for k, v in filter_by.items()])
-                    .values(**values)
-                    .execution_options(synchronize_session="fetch")
-                )
-                result = await session.execute(query)
-                try:
-                    await session.commit()
-                except SQLAlchemyError as e:
-                    await session.rollback()
-                    raise e
-                return result.rowcount
+        async with write_session(cls.model) as session:
+            query = (
+                update(cls.model)
+                .where(*[getattr(cls.model, k) == v for k, v in filter_by.items()])
+                .values(**values)
+                .execution_options(synchronize_session="fetch")
+            )
+            result = await session.execute(query)
+            return result.rowcount
 
     @classmethod
     async def patch(cls, id: int, **values) -> Optional[model]:
-        async with async_session_maker() as session:
-            async with session.begin():
-                query = (
-                    update(cls.model)
-                    .where(cls.model.id == id)
-                    .values(**values)
-                    .execution_options(synchronize_session="fetch")
-                    .returning(cls.model)
-                )
-                try:
-                    result = await session.execute(query)
-                    updated_row = result.scalar_one_or_none()
-                    return updated_row
-                except SQLAlchemyError as e:
-                    await session.rollback()
-                    raise e
+        async with write_session(cls.model) as session:
+            query = (
+                update(cls.model)
+                .where(cls.model.id == id)
+                .values(**values)
+                .execution_options(synchronize_session="fetch")
+                .returning(cls.model)
+            )
+            result = await session.execute(query)
+            updated_row = result.scalar_one_or_none()
+            return updated_row
 
     @classmethod
     async def delete(cls, **filter_by) -> int:
-        async with async_session_maker() as session:
-            async with session.begin():
-                query = delete(cls.model).where(*[getattr(cls.model, k) == v for k, v in filter_by.items()])
-                result = await session.execute(query)
-                await session.commit()
-                return result.rowcount
+        async with write_session(cls.model) as session:
+            query = delete(cls.model).where(*[getattr(cls.model, k) == v for k, v in filter_by.items()])
+            result = await session.execute(query)
+            return result.rowcount
 
 
 class UserCore(BaseCore):
     model = User
 
+    @classmethod
+    async def credit(cls, user_id: int, amount: float | Decimal, reason: str, ref: str = None) -> Optional[Decimal]:
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        return await cls._change_balance(user_id, Decimal(str(amount)), reason, ref)
+
+    @classmethod
+    async def debit(cls, user_id: int, amount: float | Decimal, reason: str, ref: str = None) -> Optional[Decimal]:
+        # None when the user doesn't exist or the balance would go negative
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        return await cls._change_balance(user_id, -Decimal(str(amount)), reason, ref)
+
+    @classmethod
+    async def _change_balance(cls, user_id: int, delta: Decimal, reason: str, ref: Optional[str]) -> Optional[Decimal]:
+        # usdt_balance = usdt_balance + delta and the ledger row in one statement, without reading the balance first
+        updated = update(User).where(User.id == user_id).values(usdt_balance=User.usdt_balance + delta)
+        if delta < 0:
+            updated = updated.where(User.usdt_balance + delta >= 0)
+        updated = updated.returning(User.id, User.usdt_balance).cte('updated_user')
+
+        query = (
+            insert(BalanceLedger)
+            .from_select(
+                ['user_id', 'delta', 'balance', 'reason', 'ref'],
+                select(
+                    updated.c.id,
+                    cast(literal(delta), Numeric),
+                    updated.c.usdt_balance,
+                    cast(literal(reason), Text),
+                    cast(literal(ref), Text),
+                )
+            )
+            .returning(BalanceLedger.balance)
+        )
+
+        async with write_session(User, BalanceLedger) as session:
+            res = await session.execute(query)
+            return res.scalar_one_or_none()
+
 class TgAuthTokenCore(BaseCore):
     model = TgAuthToken
 
+    @classmethod
+    async def delete_expired(cls, limit: int, older_than: timedelta = timedelta()) -> int:
+        # One bounded batch, walks ix_tgauthtoken_end_at so it never scans live tokens
+        expired = (
+            select(TgAuthToken.id)
+            .where(TgAuthToken.end_at < datetime.now(UTC) - older_than)
+            .order_by(TgAuthToken.end_at)
+            .limit(limit)
+        )
+        async with write_session(cls.model) as session:
+            result = await session.execute(
+                delete(TgAuthToken)
+                .where(TgAuthToken.id.in_(expired.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            return result.rowcount
+
+    @classmethod
+    async def check(cls, token: str, consume: bool = False) -> Optional[Row]:
+        # Token, expiry and the owner's login options in one round trip.
+        # Returns (user_id, end_at, valid, password, email, two_fa) or None for an unknown token
+        query = (
+            select(
+                TgAuthToken.user_pk.label('user_id'),
+                TgAuthToken.end_at,
+                (TgAuthToken.end_at > func.now()).label('valid'),
+                User.password.is_not(None).label('password'),
+                User.email.is_not(None).label('email'),
+                User.two_fa,
+            )
+            .join(User, User.id == TgAuthToken.user_pk)
+            .where(TgAuthToken.token == token)
+        )
+        if not consume:
+            async with read_session() as session:
+                return (await session.execute(query)).first()
+
+        # The outer SELECT still sees the row from the statement's snapshot, so one DELETE ... RETURNING CTE
+        # both consumes a live token and reports an expired one. Of two concurrent checks only one gets valid
+        consumed = (
+            delete(TgAuthToken)
+            .where(TgAuthToken.token == token, TgAuthToken.end_at > func.now())
+            .returning(TgAuthToken.id)
+            .cte('consumed')
+        )
+        query = query.with_only_columns(
+            *[c for c in query.selected_columns if c.name != 'valid'],
+            select(consumed.c.id).exists().label('valid'),
+        )
+        async with write_session(cls.model) as session:
+            return (await session.execute(query)).first()
+
 class WithdrawCore(BaseCore):
     model = Withdraw
 
+    @staticmethod
+    def _joined(withdraw: Union[Type[Withdraw], AliasedClass] = Withdraw) -> Select:
+        return (
+            select(
+                withdraw,
+                User,
+                Bank,
+                Currency
+            )
+            .join(User, User.id == withdraw.user_id)
+            .join(Bank, Bank.id == withdraw.bank_id)
+            .join(Currency, Currency.id == withdraw.currency_id)
+        )
+
     @classmethod
     async def find_one(cls, order_by: str = 'id', order_type: Literal['asc', 'desc'] = 'asc', **filter_by) -> Optional[Tuple[Withdraw, User, Bank, Currency]]:
         order_type: Union[asc, desc] = asc if order_type == 'asc' else desc
-        async with async_session_maker() as session:
-            print(filter_by)
-            query = (
-                select(
-                    Withdraw,
-                    User,
-                    Bank,
-                    Currency
-                )
-                .join(User, User.id == Withdraw.user_id)
-                .join(Bank, Bank.id == Withdraw.bank_id)
-                .join(Currency, Currency.id == Withdraw.currency_id)
-            )
+        async with read_session() as session:
+            query = cls._joined()
             for field, value in filter_by.items():
                 query = query.filter(getattr(Withdraw, field) == value)
 
@@ -150,15 +674,212 @@ class WithdrawCore(BaseCore):
 
     @classmethod
     async def patch(cls, id: int, **values) -> Optional[Tuple[Withdraw, User, Bank, Currency]]:
-        res = await super().patch(id, **values)
-        if res:
-            return await cls.find_one(id=id)
-        else:
-            return None
+        # UPDATE ... RETURNING as a CTE joined in the outer SELECT, so the update and the read are one statement
+        updated = (
+            update(Withdraw)
+            .where(Withdraw.id == id)
+            .values(**values)
+            .returning(*Withdraw.__table__.c)
+            .cte('updated_withdraw')
+        )
+        query = cls._joined(aliased(Withdraw, updated)).execution_options(populate_existing=True)
+
+        async with write_session(Withdraw) as session:
+            res = await session.execute(query)
+            return res.first()
+
+class WithdrawStatusTotalCore(BaseCore):
+    model = WithdrawStatusTotal
+
+    @staticmethod
+    def totals_query(statuses: Sequence[str] = None, bank_ids: Sequence[int] = None,
+                     currency_ids: Sequence[int] = None) -> Select:
+        # (count, amount, usdt_amount) per status, summed over the few bank/currency/shard rows of each status
+        query = (
+            select(
+                WithdrawStatusTotal.status,
+                func.coalesce(func.sum(WithdrawStatusTotal.count), 0).label('count'),
+                func.coalesce(func.sum(WithdrawStatusTotal.amount), 0).label('amount'),
+                func.coalesce(func.sum(WithdrawStatusTotal.usdt_amount), 0).label('usdt_amount'),
+            )
+            .group_by(WithdrawStatusTotal.status)
+        )
+        if statuses:
+            query = query.filter(WithdrawStatusTotal.status.in_(statuses))
+        if bank_ids:
+            query = query.filter(WithdrawStatusTotal.bank_id.in_(bank_ids))
+        if currency_ids:
+            query = query.filter(WithdrawStatusTotal.currency_id.in_(currency_ids))
+        return query
+
+    @classmethod
+    async def totals(cls, statuses: Sequence[str] = None, bank_ids: Sequence[int] = None,
+                     currency_ids: Sequence[int] = None) -> Dict[str, Row]:
+        async with read_session() as session:
+            result = await session.execute(cls.totals_query(statuses, bank_ids, currency_ids))
+            return {row.status: row for row in result.all()}
+
+    @staticmethod
+    def _recomputed() -> Select:
+        return (
+            select(
+                Withdraw.status,
+                Withdraw.bank_id,
+                Withdraw.currency_id,
+                func.count().label('count'),
+                func.coalesce(func.sum(Withdraw.amount), 0).label('amount'),
+                func.coalesce(func.sum(Withdraw.usdt_amount), 0).label('usdt_amount'),
+            )
+            .group_by(Withdraw.status, Withdraw.bank_id, Withdraw.currency_id)
+        )
+
+    @classmethod
+    async def diff(cls) -> List[Row]:
+        # Groups whose stored totals (summed over their shards) differ from a full recount of withdraw,
+        # emptied groups equal missing ones.
+        # Runs on the primary, a lagging replica would report differences that aren't there
+        actual = cls._recomputed().subquery('actual')
+        stored = (
+            select(
+                WithdrawStatusTotal.status,
+                WithdrawStatusTotal.bank_id,
+                WithdrawStatusTotal.currency_id,
+                *[func.sum(getattr(WithdrawStatusTotal, field)).label(field)
+                  for field in ('count', 'amount', 'usdt_amount')],
+            )
+            .group_by(WithdrawStatusTotal.status, WithdrawStatusTotal.bank_id, WithdrawStatusTotal.currency_id)
+            .subquery('stored')
+        )
+        on = and_(*[actual.c[key] == stored.c[key] for key in ('status', 'bank_id', 'currency_id')])
+        query = (
+            select(
+                *[func.coalesce(actual.c[key], stored.c[key]).label(key) for key in ('status', 'bank_id', 'currency_id')],
+                *[stored.c[field].label(f'stored_{field}') for field in ('count', 'amount', 'usdt_amount')],
+                *[actual.c[field].label(f'actual_{field}') for field in ('count', 'amount', 'usdt_amount')],
+            )
+            .select_from(actual.join(stored, on, full=True))
+            .where(or_(*[
+                func.coalesce(actual.c[field], 0) != func.coalesce(stored.c[field], 0)
+                for field in ('count', 'amount', 'usdt_amount')
+            ]))
+        )
+        async with write_session() as session:
+            result = await session.execute(query)
+            return list(result.all())
+
+    @classmethod
+    async def rebuild(cls) -> int:
+        # SHARE MODE waits for running withdraw writes and holds new ones until the rebuilt totals are committed.
+        # Each group is written back as a single row of shard 0
+        async with write_session(WithdrawStatusTotal) as session:
+            await session.execute(sql_text('LOCK TABLE withdraw IN SHARE MODE'))
+            await session.execute(delete(WithdrawStatusTotal))
+            result = await session.execute(
+                insert(WithdrawStatusTotal).from_select(
+                    ['status', 'bank_id', 'currency_id', 'count', 'amount', 'usdt_amount'], cls._recomputed()
+                )
+            )
+            return result.rowcount
 
 class TopUpCore(BaseCore):
     model = TopUp
 
+# Hourly rollups of a source table, kept up to date by triggers (see WithdrawVolume)
+class VolumeCore(BaseCore):
+    source: Type[Base] = None
+    groups: Sequence[str] = ()
+    amounts: Sequence[str] = ()
+
+    @classmethod
+    async def volume(cls, bucket: Literal['hour', 'day', 'month'], group_by: Sequence[str] = (),
+                     start: datetime = None, end: datetime = None, timezone: str = 'UTC') -> List[Row]:
+        # Hours (and their shards) summed into buckets that start at local midnight/first of the month in timezone,
+        # a year is 8760 hours per group whatever the number of source rows.
+        # start and end are applied to whole hours, end is exclusive
+        local_hour = func.timezone(timezone, cls.model.hour)
+        bucket_start = func.timezone(timezone, func.date_trunc(bucket, local_hour)).label('bucket')
+        groups = [getattr(cls.model, group) for group in group_by]
+        query = (
+            select(
+                bucket_start,
+                *groups,
+                func.sum(cls.model.count).label('count'),
+                *[func.sum(getattr(cls.model, amount)).label(amount) for amount in cls.amounts],
+            )
+            .group_by(bucket_start, *groups)
+            .having(func.sum(cls.model.count) != 0)
+            .order_by(bucket_start, *groups)
+        )
+        if start:
+            query = query.where(cls.model.hour >= start)
+        if end:
+            query = query.where(cls.model.hour < end)
+
+        async with read_session() as session:
+            result = await session.execute(query)
+            return list(result.all())
+
+    @classmethod
+    def _recomputed(cls, start: datetime, end: datetime) -> Select:
+        hour = func.date_trunc('hour', cls.source.datetime, 'UTC')
+        groups = [getattr(cls.source, group) for group in cls.groups]
+        return (
+            select(
+                hour.label('hour'),
+                *groups,
+                func.count().label('count'),
+                *[func.coalesce(func.sum(getattr(cls.source, amount)), 0).label(amount) for amount in cls.amounts],
+            )
+            .where(cls.source.datetime >= start, cls.source.datetime < end)
+            .group_by(hour, *groups)
+        )
+
+    @classmethod
+    async def rebuild(cls, start: datetime, end: datetime) -> int:
+        # Recounts the rollup rows of [start, end), which have to be whole UTC hours, into shard 0.
+        # Like WithdrawStatusTotalCore.rebuild, source writes wait for the rebuilt range to be committed
+        async with write_session(cls.model) as session:
+            await session.execute(sql_text(f'LOCK TABLE {cls.source.__tablename__} IN SHARE MODE'))
+            await session.execute(delete(cls.model).where(cls.model.hour >= start, cls.model.hour < end))
+            result = await session.execute(
+                insert(cls.model).from_select(
+                    ['hour', *cls.groups, 'count', *cls.amounts], cls._recomputed(start, end)
+                )
+            )
+            return result.rowcount
+
+    @classmethod
+    async def extent(cls) -> Tuple[Optional[datetime], Optional[datetime]]:
+        # Earliest and latest time in the source or the rollup, what a full rebuild has to cover
+        both = (
+            select(func.min(cls.source.datetime).label('first'), func.max(cls.source.datetime).label('last'))
+            .union_all(select(func.min(cls.model.hour), func.max(cls.model.hour)))
+            .subquery()
+        )
+        async with read_session() as session:
+            result = await session.execute(select(func.min(both.c.first), func.max(both.c.last)))
+            return tuple(result.one())
+
+class WithdrawVolumeCore(VolumeCore):
+    model = WithdrawVolume
+    source = Withdraw
+    groups = ('status', 'bank_id', 'currency_id')
+    amounts = ('amount', 'usdt_amount')
+
+class TopUpVolumeCore(VolumeCore):
+    model = TopUpVolume
+    source = TopUp
+    amounts = ('usdt_amount',)
+
+    @staticmethod
+    def totals_query() -> Select:
+        # All-time count and usdt_amount as a single 'all' row, a sum over the hours instead of a scan of topup
+        return select(
+            literal('all').label('key'),
+            func.coalesce(func.sum(TopUpVolume.count), 0).label('count'),
+            func.coalesce(func.sum(TopUpVolume.usdt_amount), 0).label('usdt_amount'),
+        )
+
 class ActiveApplicationCore(BaseCore):
     model = ActiveApplication
 
@@ -178,4 +899,41 @@ class FileCore(BaseCore):
     model = File
 
 class BankCore(BaseCore):
-    model = Bank
\ No newline at end of file
+    model = Bank
+
+class RateLimitBucketCore(BaseCore):
+    model = RateLimitBucket
+
+    @classmethod
+    async def hit(cls, key: str, interval: timedelta, window: timedelta) -> float:
+        # One GCRA step in a single statement: the upsert only moves tat when the request fits into the window,
+        # the outer SELECT reads the pre-statement tat to tell how long to wait otherwise. Returns 0 when allowed
+        now = func.now()
+        next_tat = func.greatest(RateLimitBucket.tat, now) + interval
+        query = pg_insert(RateLimitBucket).values(key=key, tat=now + interval)
+        allowed = query.on_conflict_do_update(
+            index_elements=[RateLimitBucket.key],
+            set_={'tat': next_tat},
+            where=next_tat - now <= window,
+        ).returning(RateLimitBucket.tat).cte('allowed')
+
+        query = select(
+            select(allowed.c.tat).scalar_subquery().label('allowed'),
+            select(func.extract('epoch', next_tat - now - window))
+            .where(RateLimitBucket.key == key)
+            .scalar_subquery()
+            .label('retry_after'),
+        )
+
+        # Its own short transaction, so a bucket row is never locked for the rest of the request
+        async with async_session_maker() as session, session.begin():
+            row = (await session.execute(query)).one()
+        if row.allowed is not None:
+            return 0.0
+        return max(float(row.retry_after or 0), 0.0)
+
+    @classmethod
+    async def delete_stale(cls) -> int:
+        async with async_session_maker() as session, session.begin():
+            result = await session.execute(delete(RateLimitBucket).where(RateLimitBucket.tat < func.now()))
+            return result.rowcount
@@ -5,8 +5,19 @@ import config
 
 from jose import jwt, JWTError
 
-from src.core import BaseCore
-from src.models import User
+from src.cache import TTLCache
+from src.core import UserCore, after_commit
+
+
+# Ids of verified users, so authenticated requests don't query user_table in steady state.
+# Only existence is cached: admin access comes from the admin token, not from User.role
+identity_cache = TTLCache(config.IDENTITY_CACHE_TTL, config.IDENTITY_CACHE_SIZE)
+
+
+def invalidate_identity(user_id: int):
+    # Dropped now and once more after commit, in case a concurrent request re-cached the old row meanwhile
+    identity_cache.pop(user_id)
+    after_commit(lambda: identity_cache.pop(user_id))
 
 
 def create_jwt_token(data: dict) -> str:
@@ -37,10 +48,13 @@ async def decode_jwt_token(token: str) -> Union[int, str, Literal['incorrect_tok
     elif user_id == 'admin':
         return 'admin'
 
-    core = BaseCore
-    core.model = User
-    user_db = await core.find_one(id=int(user_id))
+    cached_id = identity_cache.get(int(user_id))
+    if cached_id is not None:
+        return cached_id
+
+    user_db = await UserCore.load(int(user_id), columns=['id'])
     if not user_db:
         return 'user_not_found'
 
+    identity_cache.set(user_db.id, user_db.id)
     return user_db.id
\ No newline at end of file
@@ -21,18 +21,20 @@ from src.routers.user import router as user_router
 from src.routers.applications import router as application_router
 from src.admin.router import router as admin_router
 from src.telegram.bot import start_polling
+from src.utils import reap_expired_tokens
 
 async def create_test_data():
-    user_rows = await UserCore.find_all()
-    if len(user_rows) < 8:
-        for i in range(8):
-            await UserCore.add(
+    if await UserCore.count() < 8:
+        await UserCore.add_many([
+            dict(
                 first_name="Тестовое имя" + str(i),
                 tg_user_id=892097043 + i,
-            )
-        user_rows = await UserCore.find_all()
+            ) for i in range(8)
+        ])
+    # Test rows only need some users to belong to, not all of them
+    user_rows = await UserCore.find_all(columns=['id'], limit=100)
 
-    currency_rows = await CurrencyCore.find_all()
+    currency_rows = await CurrencyCore.find_all(columns=['id'])
     if not currency_rows:
         await CurrencyCore.add(
             name="Рубль",
@@ -41,31 +43,24 @@ async def create_test_data():
             rate=94.6,
             min_amount=4000,
         )
-        currency_rows = await CurrencyCore.find_all()
+        currency_rows = await CurrencyCore.find_all(columns=['id'])
 
-    bank_rows = await BankCore.find_all()
+    bank_rows = await BankCore.find_all(columns=['id'])
     if not bank_rows:
-        await BankCore.add(
-            name="Сбер",
-            code="sber"
-        )
-        await BankCore.add(
-            name="ТБанк",
-            code="tbank"
-        )
-        await BankCore.add(
-            name="Альфа",
-            code="alfa"
-        )
-        bank_rows = await BankCore.find_all()
-
-    withdraws = await WithdrawCore.find_all()
-    if len(withdraws) < 60:
+        await BankCore.add_many([
+            dict(name="Сбер", code="sber"),
+            dict(name="ТБанк", code="tbank"),
+            dict(name="Альфа", code="alfa"),
+        ])
+        bank_rows = await BankCore.find_all(columns=['id'])
+
+    if await WithdrawCore.count() < 60:
         last_dt = datetime.now(UTC)
+        withdraw_rows = []
         for i in range(60):
             amount = Decimal(randint(1, 10000) / randint(1, 9)).quantize(Decimal('0.01'))
             last_dt = last_dt - timedelta(days=randint(1, 2), hours=randint(0, 8), minutes=randint(0, 88), seconds=randint(0, 654))
-            await WithdrawCore.add(
+            withdraw_rows.append(dict(
                 user_id=choice(user_rows).id,
                 phone=f'+7 ({randint(100, 999)}) {randint(100, 999)}-{randint(10, 99)}-{randint(10, 99)}',
                 card=f'{randint(1000, 9999)} {randint(1000, 9999)} {randint(1000, 9999)} {randint(1000, 9999)}',
@@ -79,29 +74,30 @@ async def create_test_data():
                 status=choice(['completed', 'waiting', 'reject', 'correction']),
                 datetime=last_dt,
                 pre_balance=randint(500, 12423)
-            )
-        withdraws = await WithdrawCore.find_all()
+            ))
+        await WithdrawCore.add_many(withdraw_rows)
 
-    topups = await TopUpCore.find_all()
-    if len(topups) < 68:
+    if await TopUpCore.count() < 68:
         last_dt = datetime.now(UTC)
+        topup_rows = []
         for i in range(68):
             amount = Decimal(randint(1, 10000) / randint(1, 9)).quantize(Decimal('0.01'))
             last_dt = last_dt - timedelta(days=randint(1, 2), hours=randint(0, 8), minutes=randint(0, 88),
                                           seconds=randint(0, 654))
-            await TopUpCore.add(
+            topup_rows.append(dict(
                 user_id=choice(user_rows).id,
                 transaction_hash="".join([choice(string.ascii_letters) for _ in range(64)]),
                 usdt_amount=amount,
                 pre_balance=Decimal(randint(500, 12423)),
                 datetime=last_dt,
-            )
+            ))
+        await TopUpCore.add_many(topup_rows)
 
 # noinspection PyAsyncCall
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # await TgAuthTokenCore.delete()
     asyncio.create_task(start_polling())
+    asyncio.create_task(reap_expired_tokens())
     asyncio.create_task(create_test_data())
     yield
 
@@ -115,8 +111,7 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
-app.middleware("http")(middlewares.allow_credentials)
-app.middleware("http")(middlewares.check_auth)
+app.add_middleware(middlewares.RequestMiddleware)
 
 
 class Item(BaseModel):
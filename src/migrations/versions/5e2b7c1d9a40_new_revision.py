@@ -0,0 +1,40 @@
+"""new_revision
+
+Revision ID: 5e2b7c1d9a40
+Revises: 082b29525a76
+Create Date: 2026-10-18 10:12:41.208315
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2b7c1d9a40'
+down_revision: Union[str, None] = '082b29525a76'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('balanceledger',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('delta', sa.Numeric(), nullable=False),
+    sa.Column('balance', sa.Numeric(), nullable=False),
+    sa.Column('reason', sa.Text(), nullable=False),
+    sa.Column('ref', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user_table.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # A transfer is credited once, whichever check of the application gets to it
+    op.create_index('ux_balanceledger_topup_ref', 'balanceledger', ['ref'], unique=True,
+                    postgresql_where=sa.text("reason = 'topup'"))
+
+
+def downgrade() -> None:
+    op.drop_index('ux_balanceledger_topup_ref', table_name='balanceledger')
+    op.drop_table('balanceledger')
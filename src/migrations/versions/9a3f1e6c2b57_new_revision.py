@@ -0,0 +1,28 @@
+"""new_revision
+
+Revision ID: 9a3f1e6c2b57
+Revises: 5e2b7c1d9a40
+Create Date: 2026-10-18 13:40:07.512934
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a3f1e6c2b57'
+down_revision: Union[str, None] = '5e2b7c1d9a40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_tgauthtoken_user_pk_id', 'tgauthtoken', ['user_pk', sa.text('id DESC')], unique=False)
+    op.create_index('ix_tgauthtoken_end_at', 'tgauthtoken', ['end_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tgauthtoken_end_at', table_name='tgauthtoken')
+    op.drop_index('ix_tgauthtoken_user_pk_id', table_name='tgauthtoken')
@@ -0,0 +1,30 @@
+"""new_revision
+
+Revision ID: b81d4c0e7f23
+Revises: 9a3f1e6c2b57
+Create Date: 2026-10-18 15:02:33.871406
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b81d4c0e7f23'
+down_revision: Union[str, None] = '9a3f1e6c2b57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('ratelimitbucket',
+    sa.Column('key', sa.Text(), nullable=False),
+    sa.Column('tat', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('ratelimitbucket')
@@ -0,0 +1,120 @@
+"""new_revision
+
+Revision ID: c4e97a2d51f8
+Revises: b81d4c0e7f23
+Create Date: 2026-10-18 16:27:54.003918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e97a2d51f8'
+down_revision: Union[str, None] = 'b81d4c0e7f23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Signed rows of a statement: +1 for new rows, -1 for old ones
+CHANGES = {
+    'INSERT': "SELECT 1 AS sign, status, bank_id, currency_id, amount, usdt_amount FROM new_rows",
+    'DELETE': "SELECT -1 AS sign, status, bank_id, currency_id, amount, usdt_amount FROM old_rows",
+    'UPDATE': "SELECT 1 AS sign, status, bank_id, currency_id, amount, usdt_amount FROM new_rows "
+              "UNION ALL SELECT -1, status, bank_id, currency_id, amount, usdt_amount FROM old_rows",
+}
+
+# Every group is spread over SHARDS rows and a statement only adds to the row of its connection's shard.
+# The row stays locked until the writing transaction commits, so with a single row per group concurrent writes
+# to a group would wait for each other; now they only do when their connections share a shard.
+# Readers sum the shards (WithdrawStatusTotalCore.totals_query)
+SHARDS = 16
+SHARD = f"pg_backend_pid() % {SHARDS}"
+
+# Groups whose totals don't change (e.g. an update of the comment) are skipped, so they aren't locked either
+APPLY = f"""
+        INSERT INTO withdrawstatustotal AS total (status, bank_id, currency_id, shard, count, amount, usdt_amount)
+        SELECT status, bank_id, currency_id, {SHARD},
+            sum(sign), sum(sign * coalesce(amount, 0)), sum(sign * coalesce(usdt_amount, 0))
+        FROM ({{changes}}) AS changes
+        GROUP BY status, bank_id, currency_id
+        HAVING sum(sign) <> 0 OR sum(sign * coalesce(amount, 0)) <> 0 OR sum(sign * coalesce(usdt_amount, 0)) <> 0
+        ON CONFLICT (status, bank_id, currency_id, shard) DO UPDATE SET
+            count = total.count + excluded.count,
+            amount = total.amount + excluded.amount,
+            usdt_amount = total.usdt_amount + excluded.usdt_amount;
+"""
+
+
+def upgrade() -> None:
+    op.create_table('withdrawstatustotal',
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.Column('bank_id', sa.Integer(), nullable=False),
+    sa.Column('currency_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.SmallInteger(), server_default='0', nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('amount', sa.Numeric(), nullable=False),
+    sa.Column('usdt_amount', sa.Numeric(), nullable=False),
+    sa.PrimaryKeyConstraint('status', 'bank_id', 'currency_id', 'shard')
+    )
+
+    # One function for all three statement triggers, each branch only touches the transition tables its event has
+    op.execute(f"""
+    CREATE FUNCTION withdraw_status_total_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {APPLY.format(changes=CHANGES['INSERT'])}
+        ELSIF TG_OP = 'DELETE' THEN
+            {APPLY.format(changes=CHANGES['DELETE'])}
+        ELSE
+            {APPLY.format(changes=CHANGES['UPDATE'])}
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """)
+    op.execute("""
+    CREATE FUNCTION withdraw_status_total_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM withdrawstatustotal;
+        RETURN NULL;
+    END
+    $$
+    """)
+
+    # Existing withdraws are counted under a lock, so no write slips in between the backfill and the triggers
+    op.execute("LOCK TABLE withdraw IN SHARE ROW EXCLUSIVE MODE")
+    op.execute("""
+    CREATE TRIGGER withdraw_status_total_insert AFTER INSERT ON withdraw
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION withdraw_status_total_apply()
+    """)
+    op.execute("""
+    CREATE TRIGGER withdraw_status_total_update AFTER UPDATE ON withdraw
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION withdraw_status_total_apply()
+    """)
+    op.execute("""
+    CREATE TRIGGER withdraw_status_total_delete AFTER DELETE ON withdraw
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION withdraw_status_total_apply()
+    """)
+    op.execute("""
+    CREATE TRIGGER withdraw_status_total_truncate AFTER TRUNCATE ON withdraw
+    FOR EACH STATEMENT EXECUTE FUNCTION withdraw_status_total_truncate()
+    """)
+    op.execute("""
+    INSERT INTO withdrawstatustotal (status, bank_id, currency_id, count, amount, usdt_amount)
+    SELECT status, bank_id, currency_id, count(*), coalesce(sum(amount), 0), coalesce(sum(usdt_amount), 0)
+    FROM withdraw
+    GROUP BY status, bank_id, currency_id
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER withdraw_status_total_truncate ON withdraw")
+    op.execute("DROP TRIGGER withdraw_status_total_delete ON withdraw")
+    op.execute("DROP TRIGGER withdraw_status_total_update ON withdraw")
+    op.execute("DROP TRIGGER withdraw_status_total_insert ON withdraw")
+    op.execute("DROP FUNCTION withdraw_status_total_truncate()")
+    op.execute("DROP FUNCTION withdraw_status_total_apply()")
+    op.drop_table('withdrawstatustotal')
@@ -0,0 +1,84 @@
+"""new_revision
+
+Revision ID: d7a3b9e04c12
+Revises: c4e97a2d51f8
+Create Date: 2026-10-18 18:05:12.640577
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a3b9e04c12'
+down_revision: Union[str, None] = 'c4e97a2d51f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Same fields and formatting the admin search used to ILIKE one by one, names of users, banks and currencies
+# are searched on their own tables by src.admin.search
+WITHDRAW_DOCUMENT = """lower(concat_ws(' ', NEW.id, round(NEW.usdt_amount, 2), round(NEW.amount, 2),
+    to_char(NEW.datetime AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'),
+    NEW.phone, NEW.card, NEW.comment, NEW.tag, NEW.receiver))"""
+WITHDRAW_FIELDS = 'id, usdt_amount, amount, datetime, phone, card, comment, tag, receiver'
+
+TOPUP_DOCUMENT = """lower(concat_ws(' ', NEW.id, round(NEW.usdt_amount, 2),
+    to_char(NEW.datetime AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')))"""
+TOPUP_FIELDS = 'id, usdt_amount, datetime'
+
+
+def create_search_document(table: str, document: str, fields: str):
+    op.add_column(table, sa.Column('search_document', sa.Text(), nullable=True))
+    op.execute(f"""
+    CREATE FUNCTION {table}_search_document() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_document := {document};
+        RETURN NEW;
+    END
+    $$
+    """)
+    op.execute(f"""
+    CREATE TRIGGER {table}_search_document BEFORE INSERT OR UPDATE OF {fields} ON {table}
+    FOR EACH ROW EXECUTE FUNCTION {table}_search_document()
+    """)
+    # Fires the trigger for the existing rows
+    op.execute(f"UPDATE {table} SET id = id")
+    op.create_index(f'ix_{table}_search_document', table, ['search_document'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'search_document': 'gin_trgm_ops'})
+
+
+def drop_search_document(table: str):
+    op.drop_index(f'ix_{table}_search_document', table_name=table)
+    op.execute(f"DROP TRIGGER {table}_search_document ON {table}")
+    op.execute(f"DROP FUNCTION {table}_search_document()")
+    op.drop_column(table, 'search_document')
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    create_search_document('withdraw', WITHDRAW_DOCUMENT, WITHDRAW_FIELDS)
+    create_search_document('topup', TOPUP_DOCUMENT, TOPUP_FIELDS)
+
+    # user_id and bank_id lookups use the composite indexes of e5b18c3f6a29
+    op.create_index('ix_withdraw_card', 'withdraw', ['card'], unique=False)
+    op.create_index('ix_withdraw_phone', 'withdraw', ['phone'], unique=False)
+    op.create_index('ix_withdraw_currency_id', 'withdraw', ['currency_id'], unique=False)
+    op.create_index('ix_user_table_tg_username_trgm', 'user_table', ['tg_username'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'tg_username': 'gin_trgm_ops'})
+    op.create_index('ix_user_table_first_name_trgm', 'user_table', ['first_name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'first_name': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_table_first_name_trgm', table_name='user_table')
+    op.drop_index('ix_user_table_tg_username_trgm', table_name='user_table')
+    op.drop_index('ix_withdraw_currency_id', table_name='withdraw')
+    op.drop_index('ix_withdraw_phone', table_name='withdraw')
+    op.drop_index('ix_withdraw_card', table_name='withdraw')
+
+    drop_search_document('topup')
+    drop_search_document('withdraw')
@@ -0,0 +1,59 @@
+"""new_revision
+
+Revision ID: e5b18c3f6a29
+Revises: d7a3b9e04c12
+Create Date: 2026-10-18 19:42:31.208154
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b18c3f6a29'
+down_revision: Union[str, None] = 'd7a3b9e04c12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# One index per access path of the admin lists and the per-user lookups, with the keyset order (column, id) after
+# the filtered column, so a filtered page is read in order without a sort.
+# They also serve the plain user_id/bank_id lookups, so there are no single column indexes on those
+INDEXES = [
+    ('ix_withdraw_datetime_id', 'withdraw', ['datetime', 'id']),
+    ('ix_withdraw_amount_id', 'withdraw', ['amount', 'id']),
+    ('ix_withdraw_usdt_amount_id', 'withdraw', ['usdt_amount', 'id']),
+    ('ix_withdraw_status_datetime_id', 'withdraw', ['status', 'datetime', 'id']),
+    ('ix_withdraw_bank_id_datetime_id', 'withdraw', ['bank_id', 'datetime', 'id']),
+    ('ix_withdraw_user_id_datetime_id', 'withdraw', ['user_id', 'datetime', 'id']),
+    ('ix_topup_datetime_id', 'topup', ['datetime', 'id']),
+    ('ix_topup_usdt_amount_id', 'topup', ['usdt_amount', 'id']),
+    ('ix_topup_user_id_datetime_id', 'topup', ['user_id', 'datetime', 'id']),
+]
+
+
+def create_concurrently(indexes):
+    # CONCURRENTLY can't run in a transaction. A failed build leaves an invalid index behind,
+    # so it's dropped first and the migration can simply be run again
+    with op.get_context().autocommit_block():
+        for name, table, columns in indexes:
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+
+
+def drop_concurrently(indexes):
+    with op.get_context().autocommit_block():
+        for name, table, _ in indexes:
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
+
+
+def upgrade() -> None:
+    create_concurrently(INDEXES)
+    op.execute("ANALYZE withdraw")
+    op.execute("ANALYZE topup")
+
+
+def downgrade() -> None:
+    drop_concurrently(INDEXES)
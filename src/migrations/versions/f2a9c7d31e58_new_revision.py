@@ -0,0 +1,145 @@
+"""new_revision
+
+Revision ID: f2a9c7d31e58
+Revises: e5b18c3f6a29
+Create Date: 2026-10-18 21:14:06.385217
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2a9c7d31e58'
+down_revision: Union[str, None] = 'e5b18c3f6a29'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# source table, rollup table, group columns besides the hour, summed columns
+ROLLUPS = [
+    ('withdraw', 'withdrawvolume', ['status', 'bank_id', 'currency_id'], ['amount', 'usdt_amount']),
+    ('topup', 'topupvolume', [], ['usdt_amount']),
+]
+
+HOUR = "date_trunc('hour', datetime, 'UTC')"
+
+# Like withdrawstatustotal, every bucket is spread over SHARDS rows and a statement only adds to the row of its
+# connection's shard, so writers of the current hour don't queue on one row lock until they commit.
+# VolumeCore.volume sums them
+SHARDS = 16
+SHARD = f"pg_backend_pid() % {SHARDS}"
+
+
+def apply_sql(rollup: str, groups: list, amounts: list, changes: str) -> str:
+    # Like withdrawstatustotal: signed rows of the statement summed per bucket, unchanged buckets are skipped
+    keys = ', '.join(['hour'] + groups)
+    sums = ['sum(sign)'] + [f'sum(sign * coalesce({amount}, 0))' for amount in amounts]
+    return f"""
+        INSERT INTO {rollup} AS total ({keys}, shard, count, {', '.join(amounts)})
+        SELECT {keys}, {SHARD}, {', '.join(sums)}
+        FROM ({changes}) AS changes
+        GROUP BY {keys}
+        HAVING {' OR '.join(f'{total} <> 0' for total in sums)}
+        ON CONFLICT ({keys}, shard) DO UPDATE SET
+            {', '.join(f'{column} = total.{column} + excluded.{column}' for column in ['count'] + amounts)};
+    """
+
+
+def create_rollup(source: str, rollup: str, groups: list, amounts: list):
+    columns = ', '.join(groups + amounts)
+    changes = {
+        'INSERT': f"SELECT 1 AS sign, {HOUR} AS hour, {columns} FROM new_rows",
+        'DELETE': f"SELECT -1 AS sign, {HOUR} AS hour, {columns} FROM old_rows",
+        'UPDATE': f"SELECT 1 AS sign, {HOUR} AS hour, {columns} FROM new_rows "
+                  f"UNION ALL SELECT -1, {HOUR}, {columns} FROM old_rows",
+    }
+    op.execute(f"""
+    CREATE FUNCTION {rollup}_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {apply_sql(rollup, groups, amounts, changes['INSERT'])}
+        ELSIF TG_OP = 'DELETE' THEN
+            {apply_sql(rollup, groups, amounts, changes['DELETE'])}
+        ELSE
+            {apply_sql(rollup, groups, amounts, changes['UPDATE'])}
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """)
+    op.execute(f"""
+    CREATE FUNCTION {rollup}_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM {rollup};
+        RETURN NULL;
+    END
+    $$
+    """)
+
+    # Existing rows are counted under a lock, so no write slips in between the backfill and the triggers
+    op.execute(f"LOCK TABLE {source} IN SHARE ROW EXCLUSIVE MODE")
+    op.execute(f"""
+    CREATE TRIGGER {rollup}_insert AFTER INSERT ON {source}
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_apply()
+    """)
+    op.execute(f"""
+    CREATE TRIGGER {rollup}_update AFTER UPDATE ON {source}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_apply()
+    """)
+    op.execute(f"""
+    CREATE TRIGGER {rollup}_delete AFTER DELETE ON {source}
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_apply()
+    """)
+    op.execute(f"""
+    CREATE TRIGGER {rollup}_truncate AFTER TRUNCATE ON {source}
+    FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_truncate()
+    """)
+    keys = ', '.join(['hour'] + groups)
+    totals = ', '.join(['count(*)'] + [f'coalesce(sum({amount}), 0)' for amount in amounts])
+    op.execute(f"""
+    INSERT INTO {rollup} ({keys}, count, {', '.join(amounts)})
+    SELECT {', '.join([f'{HOUR} AS hour'] + groups)}, {totals}
+    FROM {source}
+    GROUP BY {keys}
+    """)
+
+
+def drop_rollup(source: str, rollup: str):
+    for event in ('truncate', 'delete', 'update', 'insert'):
+        op.execute(f"DROP TRIGGER {rollup}_{event} ON {source}")
+    op.execute(f"DROP FUNCTION {rollup}_truncate()")
+    op.execute(f"DROP FUNCTION {rollup}_apply()")
+
+
+def upgrade() -> None:
+    op.create_table('withdrawvolume',
+    sa.Column('hour', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.Column('bank_id', sa.Integer(), nullable=False),
+    sa.Column('currency_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.SmallInteger(), server_default='0', nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('amount', sa.Numeric(), nullable=False),
+    sa.Column('usdt_amount', sa.Numeric(), nullable=False),
+    sa.PrimaryKeyConstraint('hour', 'status', 'bank_id', 'currency_id', 'shard')
+    )
+    op.create_table('topupvolume',
+    sa.Column('hour', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('shard', sa.SmallInteger(), server_default='0', nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('usdt_amount', sa.Numeric(), nullable=False),
+    sa.PrimaryKeyConstraint('hour', 'shard')
+    )
+
+    for source, rollup, groups, amounts in ROLLUPS:
+        create_rollup(source, rollup, groups, amounts)
+
+
+def downgrade() -> None:
+    for source, rollup, _, _ in reversed(ROLLUPS):
+        drop_rollup(source, rollup)
+    op.drop_table('topupvolume')
+    op.drop_table('withdrawvolume')
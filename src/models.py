@@ -5,7 +5,8 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from typing import List, Annotated, Literal
 
-from sqlalchemy import Integer, func, ForeignKey, DateTime, BigInteger, Text, Numeric
+from sqlalchemy import Integer, func, ForeignKey, DateTime, BigInteger, SmallInteger, Text, Numeric, Index, \
+    text as sql_text
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 
 import config
@@ -39,11 +40,34 @@ class User(Base):
     def __str__(self):
         return f'User: {self.id=}, {self.tg_username=}, {self.role=}'
 
+    __table_args__ = (
+        Index('ix_user_table_tg_username_trgm', 'tg_username',
+              postgresql_using='gin', postgresql_ops={'tg_username': 'gin_trgm_ops'}),
+        Index('ix_user_table_first_name_trgm', 'first_name',
+              postgresql_using='gin', postgresql_ops={'first_name': 'gin_trgm_ops'}),
+    )
+
 
 def token_end_at():
     return datetime.now() + timedelta(minutes=config.TOKEN_LIFETIME)
 
 
+class BalanceLedger(Base):
+    # Append-only, one row per change of User.usdt_balance made through UserCore.credit/debit
+    id = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('user_table.id'))
+    delta: Mapped[float | Decimal] = mapped_column(Numeric)
+    balance: Mapped[float | Decimal] = mapped_column(Numeric)
+    reason: Mapped[text]
+    ref: Mapped[text | None]
+    created_at: Mapped[created_at]
+
+    __table_args__ = (
+        # ref of a top-up is the transaction id, a transfer is credited once (migration 5e2b7c1d9a40)
+        Index('ux_balanceledger_topup_ref', 'ref', unique=True, postgresql_where=sql_text("reason = 'topup'")),
+    )
+
+
 class TgAuthToken(Base):
     @staticmethod
     def generate_token():
@@ -57,6 +81,12 @@ class TgAuthToken(Base):
     end_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=token_end_at)
     token: Mapped[text] = mapped_column(default=generate_token, unique=True)
 
+    __table_args__ = (
+        # Latest token of a user (callback_update) and the expired token sweep
+        Index('ix_tgauthtoken_user_pk_id', user_pk, id.desc()),
+        Index('ix_tgauthtoken_end_at', end_at),
+    )
+
     def __str__(self):
         return f'TgAuthToken: {self.id=}, {self.created_at=}, {self.end_at=}, {self.token=}'
 
@@ -77,6 +107,51 @@ class Withdraw(Base):
     datetime: Mapped[created_at]
     pre_balance: Mapped[float | Decimal] = mapped_column(Numeric)
     document: Mapped[str | None] = None
+    # Lowercased own fields for admin search, filled by a trigger (migration d7a3b9e04c12), not loaded by default
+    search_document: Mapped[str | None] = mapped_column(Text, deferred=True)
+
+    __table_args__ = (
+        Index('ix_withdraw_search_document', search_document,
+              postgresql_using='gin', postgresql_ops={'search_document': 'gin_trgm_ops'}),
+        Index('ix_withdraw_card', 'card'),
+        Index('ix_withdraw_phone', 'phone'),
+        Index('ix_withdraw_currency_id', currency_id),
+        # Admin list filters and sort orders, each followed by the keyset tiebreaker (migration e5b18c3f6a29)
+        Index('ix_withdraw_datetime_id', 'datetime', 'id'),
+        Index('ix_withdraw_amount_id', 'amount', 'id'),
+        Index('ix_withdraw_usdt_amount_id', 'usdt_amount', 'id'),
+        Index('ix_withdraw_status_datetime_id', 'status', 'datetime', 'id'),
+        Index('ix_withdraw_bank_id_datetime_id', 'bank_id', 'datetime', 'id'),
+        Index('ix_withdraw_user_id_datetime_id', 'user_id', 'datetime', 'id'),
+    )
+
+
+class WithdrawStatusTotal(Base):
+    # Count and sums of withdraws per status, bank and currency. Maintained by statement-level triggers on withdraw
+    # (migration c4e97a2d51f8), verified and rebuilt with `python -m commands.verify_withdraw_totals`
+    status: Mapped[str] = mapped_column(Text, primary_key=True)
+    bank_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    currency_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # A group is split over a few rows so that concurrent writers don't queue on one row lock, the totals are their sum
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True, default=0, server_default='0')
+    count: Mapped[int] = mapped_column(BigInteger, default=0)
+    amount: Mapped[float | Decimal] = mapped_column(Numeric, default=0)
+    usdt_amount: Mapped[float | Decimal] = mapped_column(Numeric, default=0)
+
+
+class WithdrawVolume(Base):
+    # Count and sums of withdraws per UTC hour, status, bank and currency for /admin/analytics/volume.
+    # Maintained by statement-level triggers on withdraw (migration f2a9c7d31e58), rebuilt with
+    # `python -m commands.backfill_volume`
+    hour: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    status: Mapped[str] = mapped_column(Text, primary_key=True)
+    bank_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    currency_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Split like WithdrawStatusTotal.shard, the volume is the sum over the shards
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True, default=0, server_default='0')
+    count: Mapped[int] = mapped_column(BigInteger, default=0)
+    amount: Mapped[float | Decimal] = mapped_column(Numeric, default=0)
+    usdt_amount: Mapped[float | Decimal] = mapped_column(Numeric, default=0)
 
 
 class TopUp(Base):
@@ -86,6 +161,23 @@ class TopUp(Base):
     transaction_hash: Mapped[text]
     usdt_amount: Mapped[float | Decimal] = mapped_column(Numeric)
     pre_balance: Mapped[float | Decimal] = mapped_column(Numeric)
+    search_document: Mapped[str | None] = mapped_column(Text, deferred=True)
+
+    __table_args__ = (
+        Index('ix_topup_search_document', search_document,
+              postgresql_using='gin', postgresql_ops={'search_document': 'gin_trgm_ops'}),
+        Index('ix_topup_datetime_id', 'datetime', 'id'),
+        Index('ix_topup_usdt_amount_id', 'usdt_amount', 'id'),
+        Index('ix_topup_user_id_datetime_id', 'user_id', 'datetime', 'id'),
+    )
+
+
+class TopUpVolume(Base):
+    # Count and sum of topups per UTC hour, maintained like WithdrawVolume
+    hour: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True, default=0, server_default='0')
+    count: Mapped[int] = mapped_column(BigInteger, default=0)
+    usdt_amount: Mapped[float | Decimal] = mapped_column(Numeric, default=0)
 
 
 class ActiveApplication(Base):
@@ -161,3 +253,10 @@ class Bank(Base):
     icon: Mapped[str | None] = None
 
     withdraw: Mapped[List['Withdraw']] = relationship(cascade="all, delete")
+
+
+class RateLimitBucket(Base):
+    # Shared state of src.ratelimit limits when RATE_LIMIT_BACKEND is 'postgres', one row per limit and client
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    # GCRA theoretical arrival time, the bucket is full again once it's in the past
+    tat: Mapped[datetime] = mapped_column(DateTime(timezone=True))
@@ -0,0 +1,85 @@
+import math
+import time
+from datetime import timedelta
+from typing import Callable, Hashable
+
+from fastapi import Request, HTTPException
+
+import config
+from src.cache import TTLCache
+from src.core import RateLimitBucketCore
+
+
+# Token bucket kept as a single "theoretical arrival time" (GCRA): every call moves it by interval,
+# a call is rejected when that would put it more than burst intervals ahead of now
+class MemoryBuckets:
+    def __init__(self, maxsize: int):
+        self.tats = TTLCache(ttl=0, maxsize=maxsize)
+
+    async def hit(self, key: Hashable, interval: float, window: float) -> float:
+        now = time.monotonic()
+        tat = max(self.tats.get(key, now), now) + interval
+        if tat - now > window:
+            return tat - now - window
+        # Once tat has passed the bucket is full again, so the entry can expire with it
+        self.tats.set(key, tat, ttl=tat - now)
+        return 0.0
+
+
+# Shared between worker processes through the ratelimitbucket table
+class PostgresBuckets:
+    PURGE_INTERVAL = 600 # seconds
+
+    def __init__(self):
+        self.purge_at = time.monotonic() + self.PURGE_INTERVAL
+
+    async def hit(self, key: Hashable, interval: float, window: float) -> float:
+        if time.monotonic() > self.purge_at:
+            self.purge_at = time.monotonic() + self.PURGE_INTERVAL
+            print(f'Rate limit buckets purged: {await RateLimitBucketCore.delete_stale()}')
+        return await RateLimitBucketCore.hit(
+            ':'.join(map(str, key)), timedelta(seconds=interval), timedelta(seconds=window)
+        )
+
+
+backend = PostgresBuckets() if config.RATE_LIMIT_BACKEND == 'postgres' else MemoryBuckets(config.RATE_LIMIT_MAX_KEYS)
+
+
+def client_ip(request: Request) -> str:
+    if config.RATE_LIMIT_IP_HEADER:
+        forwarded = request.headers.get(config.RATE_LIMIT_IP_HEADER)
+        if forwarded:
+            # Entries on the left come from the client and can be anything, the last one is added by our proxy
+            return forwarded.split(',')[-1].strip()
+    return request.client.host if request.client else ''
+
+
+def user_or_ip(request: Request) -> str:
+    user_id = getattr(request.state, 'user_id', None)
+    return f'user:{user_id}' if user_id is not None else f'ip:{client_ip(request)}'
+
+
+# Allows rate calls per `per` seconds on average and up to burst calls at once for every key.
+# Used as a route dependency, so an over-limit call is answered with 429 before the endpoint touches the database:
+#   @router.post('/check_token/', dependencies=[Depends(RateLimit('check_token', rate=10, per=60))])
+class RateLimit:
+    def __init__(self, name: str, rate: int, per: float, burst: int = None, key: Callable[[Request], str] = client_ip):
+        self.name = name
+        self.interval = per / rate
+        self.window = self.interval * (burst or rate)
+        self.key = key
+
+    async def retry_after(self, key: Hashable) -> float:
+        if not config.RATE_LIMIT_ENABLED:
+            return 0.0
+        try:
+            return await backend.hit((self.name, key), self.interval, self.window)
+        except Exception as e:
+            # A broken shared backend shouldn't take the endpoints down with it
+            print(f'Rate limit {self.name} failed open: {e!r}')
+            return 0.0
+
+    async def __call__(self, request: Request):
+        retry_after = await self.retry_after(self.key(request))
+        if retry_after:
+            raise HTTPException(429, 'Too many requests', headers={'Retry-After': str(math.ceil(retry_after))})
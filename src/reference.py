@@ -0,0 +1,81 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Type, Sequence, Dict, List, Optional, Any
+
+from sqlalchemy import select
+
+import config
+from database import async_session_maker
+from src.core import BaseCore, CurrencyCore, BankCore, CommissionCore, after_commit
+
+
+# In-memory copy of a small, rarely changed table, reloaded as a whole once ttl runs out.
+# Rows are plain namespaces of the column values, not entities, so nothing shared between requests is bound to
+# (or expired by) a request's session, and a patch of the entity leaves the cached copy alone
+class ReferenceTable:
+    def __init__(self, core: Type[BaseCore], ttl: float, keys: Sequence[str] = ('id',)):
+        self.core = core
+        self.ttl = ttl
+        self.keys = keys
+        self.rows: List[Any] = []
+        self.indexes: Dict[str, Dict[Any, Any]] = {key: {} for key in keys}
+        self.expires_at = 0.0
+        # Bumped by invalidate(), so a load that raced with a write doesn't get cached
+        self.generation = 0
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        if time.monotonic() < self.expires_at:
+            return
+        async with self._lock:
+            if time.monotonic() < self.expires_at:
+                return
+            generation = self.generation
+            rows = await self.fetch()
+            self.rows = rows
+            self.indexes = {key: {getattr(row, key): row for row in rows} for key in self.keys}
+            if generation == self.generation:
+                self.expires_at = time.monotonic() + self.ttl
+
+    async def fetch(self) -> List[SimpleNamespace]:
+        # Own short-lived session on the primary: the request's session may be rolled back after the load,
+        # and a lagging replica would bring back the rows from before an invalidate() for a whole ttl
+        model = self.core.model
+        async with async_session_maker() as session:
+            result = await session.execute(select(*model.__table__.columns).order_by(model.id))
+            return [SimpleNamespace(**row._mapping) for row in result]
+
+    async def all(self, ids: Sequence[int] = None) -> List[Any]:
+        await self.load()
+        if ids:
+            return [row for row in self.rows if row.id in ids]
+        return list(self.rows)
+
+    async def get(self, **key) -> Optional[Any]:
+        (field, value), = key.items()
+        await self.load()
+        return self.indexes[field].get(value)
+
+    async def filter(self, **filter_by) -> List[Any]:
+        await self.load()
+        return [row for row in self.rows if all(getattr(row, k) == v for k, v in filter_by.items())]
+
+    def expire(self):
+        self.generation += 1
+        self.expires_at = 0.0
+
+    def invalidate(self):
+        # Expire now for the writing request itself, and again once its transaction is committed
+        self.expire()
+        after_commit(self.expire)
+
+
+class ReferenceRegistry:
+    def __init__(self, ttl: float):
+        self.currencies = ReferenceTable(CurrencyCore, ttl, keys=('id', 'code'))
+        self.banks = ReferenceTable(BankCore, ttl, keys=('id', 'code'))
+        self.commission_steps = ReferenceTable(CommissionCore, ttl)
+
+
+references = ReferenceRegistry(config.REFERENCE_TTL)
@@ -2,14 +2,17 @@ from datetime import datetime, UTC, timedelta
 from re import compile
 from typing import List, Literal
 
-from fastapi import APIRouter, Request, Body
+from fastapi import APIRouter, Request, Body, Depends
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel, Field
 
 from src.core import ActiveApplicationCore
+from src.ratelimit import RateLimit, user_or_ip
 
 router = APIRouter(prefix='', tags=['Заявки'])
 
+create_topup_limit = RateLimit('create_topup', rate=5, per=60, key=user_or_ip)
+
 class Withdraw(BaseModel):
     id: int | None = Field(default=None)
     name: str
@@ -22,14 +25,6 @@ class Withdraw(BaseModel):
     comment: str | None
 
 
-eng_to_rus_bank = {
-    'sber': 'Сбер',
-    'tbank': 'Тбанк (Тинькофф)',
-    'alfa': 'Альфа',
-    'vtb': 'ВТБ',
-    'open': 'Открытие'
-}
-
 @router.post('/withdraw/')
 async def main_page(request: Request, withdraw: List[Withdraw]):
     print(withdraw)
@@ -37,11 +32,11 @@ async def main_page(request: Request, withdraw: List[Withdraw]):
 class Amount(BaseModel):
     amount: int|float
 
-@router.post('/create_topup/')
+@router.post('/create_topup/', dependencies=[Depends(create_topup_limit)])
 async def top_up(request: Request, amount: float = Body(embed=True)):
     user_id = request.state.user_id
     print(user_id, amount)
-    user_applications = await ActiveApplicationCore.find_one(user_pk=user_id, type='topup')
+    user_applications = await ActiveApplicationCore.find_one(user_pk=user_id, type='topup', columns=['id'])
     if user_applications:
         raise HTTPException(400, 'There is already an application')
     await ActiveApplicationCore.add(
@@ -25,15 +25,15 @@ class ResponseUser(BaseModel):
 @router.get('/get_user/')
 async def get_user(request: Request):
     user_id = request.state.user_id
-    user = await UserCore.find_one(id=user_id)
+    user = await UserCore.load(user_id)
     resp = ResponseUser(**user.__dict__)
     return resp
 
 @router.get('/stats/')
 async def stats(request: Request):
     user_id = request.state.user_id
-    stats_topup = await TopUpCore.find_all(user_pk=user_id)
-    stats_payout = await WithdrawCore.find_all(user_pk=user_id)
+    stats_topup = await TopUpCore.find_all(order_by='datetime', order_type='desc', user_id=user_id)
+    stats_payout = await WithdrawCore.find_all(order_by='datetime', order_type='desc', user_id=user_id)
 
     all_stats = []
 
@@ -150,7 +150,8 @@ async def save_pattern(request: Request, pattern: Pattern):
             raise HTTPException(400, {'successful': False, 'already_exists': True})
 
     last_pattern_id = await PatternCore.find_one(
-        order_type='desc'
+        order_type='desc',
+        columns=['id'],
     )
 
     if not last_pattern_id:
@@ -164,13 +165,10 @@ async def save_pattern(request: Request, pattern: Pattern):
         name=pattern.name,
     )
 
-    for field in pattern.fields:
-        without_id_field = field.model_dump()
-        without_id_field.pop('id')
-        await PatternFieldCore.add(
-            pattern_pk=new_pattern_id,
-            **without_id_field
-        )
+    await PatternFieldCore.add_many([
+        dict(pattern_pk=new_pattern_id, **field.model_dump(exclude={'id'}))
+        for field in pattern.fields
+    ])
 
     return {'successful': True}
 
@@ -192,7 +190,7 @@ async def get_patterns(request: Request, limit: int = 20) -> List[Pattern]:
 async def delete_pattern(request: Request, id: int):
     user_id = request.state.user_id
 
-    pattern_exists = True if (await PatternCore.find_one(user_pk=user_id, id=id)) else False
+    pattern_exists = True if (await PatternCore.find_one(user_pk=user_id, id=id, columns=['id'])) else False
 
     if not pattern_exists:
         raise HTTPException(403, {'error': True})
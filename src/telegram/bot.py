@@ -1,3 +1,4 @@
+import math
 from datetime import datetime, UTC
 import re
 from typing import Union
@@ -7,14 +8,17 @@ from aiogram import types as tgtypes, F, exceptions
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Filter
 from aiogram.types import InlineKeyboardMarkup as IMarkup, InlineKeyboardButton as IButton, Message, CallbackQuery
-from sqlalchemy.exc import SQLAlchemyError
 
 import config
 from src.core import UserCore, TgAuthTokenCore
+from src.ratelimit import RateLimit
 
 bot = aiogram.Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode='html'))
 dispatcher = aiogram.Dispatcher()
 
+# Keyed by telegram id, /start and token requests both write to the database
+tg_limit = RateLimit('telegram', rate=10, per=60, burst=5)
+
 class PrivateF(Filter):
     async def __call__(self, update: Union[CallbackQuery, Message], *args, **kwargs):
         chat = update.chat if type(update) == Message else update.message.chat
@@ -41,16 +45,15 @@ class FullmatchF(Filter):
 @dispatcher.message(PrivateF(), F.text and F.text[:6] == '/start')
 async def start_message(message: Message):
     user = message.from_user
-
-    db_user = await UserCore.find_one(tg_user_id=user.id)
-
-    if not db_user:
-        await UserCore.add(**{
-            'tg_user_id': user.id,
-            'first_name': user.first_name or 'noname',
-            'tg_username': user.username,
-        })
-
+    if await tg_limit.retry_after(user.id):
+        return
+
+    await UserCore.upsert(
+        ['tg_user_id'],
+        tg_user_id=user.id,
+        first_name=user.first_name or 'noname',
+        tg_username=user.username,
+    )
 
     await bot.send_message(
         chat_id=user.id,
@@ -67,17 +70,18 @@ async def start_message(message: Message):
 @dispatcher.callback_query(PrivateF(), FullmatchF('get_token(_del_msg|)'))
 async def callback_update(callback: CallbackQuery):
     user = callback.from_user
-    db_user = await UserCore.find_one(tg_user_id=user.id)
+    retry_after = await tg_limit.retry_after(user.id)
+    if retry_after:
+        await callback.answer(f'Слишком много запросов, попробуйте через {math.ceil(retry_after)} с.')
+        return
+    db_user = await UserCore.load(user.id, key='tg_user_id')
 
     created_token = await TgAuthTokenCore.find_one(user_pk=db_user.id, order_type='desc')
     if not created_token or (created_token and created_token.end_at < datetime.now(UTC)):
-        try:
-            await TgAuthTokenCore.add(user_pk=db_user.id)
-        # If there's a 1,52784834*10^47 chance of a match happening)
-        except SQLAlchemyError:
-            await TgAuthTokenCore.add(user_pk=db_user.id)
-
-        created_token = await TgAuthTokenCore.find_one(user_pk=db_user.id, order_type='desc')
+        created_token = None
+        # If there's a 1,52784834*10^47 chance of a match happening), the token is generated again
+        while not created_token:
+            created_token = await TgAuthTokenCore.upsert(['token'], user_pk=db_user.id)
 
     await bot.send_message(
         chat_id=user.id,
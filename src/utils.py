@@ -1,26 +1,46 @@
 import asyncio
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Literal
 
 from passlib.context import CryptContext
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
+from decimal import Decimal
 import httpx
+from sqlalchemy.exc import IntegrityError
 
 import config
-from src.core import ActiveApplicationCore, TopUpCore, UserCore
+from src.core import ActiveApplicationCore, TopUpCore, UserCore, TgAuthTokenCore, unit_of_work
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so a few threads are enough to keep it off the event loop.
+# The semaphore keeps waiting logins in the loop instead of piling up in the executor queue
+_hash_executor = ThreadPoolExecutor(max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+_hash_slots = asyncio.Semaphore(config.PASSWORD_HASH_WORKERS)
+
+
+async def _run_hasher(func, *args):
+    async with _hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
 
 
 class Auth:
     @staticmethod
-    def get_password_hash(password: str) -> str:
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        return pwd_context.hash(password)
+    async def get_password_hash(password: str) -> str:
+        return await _run_hasher(pwd_context.hash, password)
 
     @staticmethod
-    def verify_password(plain_password: str, hashed_password: str) -> bool:
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        return pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(plain_password: str, hashed_password: str) -> bool:
+        return await _run_hasher(pwd_context.verify, plain_password, hashed_password)
+
+
+class TopUpError(Exception):
+    # An application that can't be credited, its transaction is rolled back and the other applications go on
+    pass
+
 
 class CheckingTopUps:
     def __init__(self):
@@ -31,7 +51,12 @@ class CheckingTopUps:
         while True:
             time.sleep(120)
             for i in applications:
-                await self.check_top_up(i.id)
+                try:
+                    await self.check_top_up(i.id)
+                except TopUpError as e:
+                    print(f'Top-up application {i.id} skipped: {e}')
+                except Exception as e:
+                    print(f'Top-up check of {i.id} failed: {e!r}')
 
     @staticmethod
     async def check_top_up(application_id: str, time_interval: int = 60):
@@ -82,22 +107,63 @@ class CheckingTopUps:
                         if transfer_amount != application_row.usdt_amount:
                             continue
 
-                        await ActiveApplicationCore.delete(id=application_id)
-
-                        user_row = await UserCore.find_one(id=application_row.user_pk)
-                        pre_value = user_row.usdt_balance
-                        await UserCore.update(
-                            {'id': user_row.id},
-                            usdt_balance=user_row.usdt_balance + transfer_amount
-                        )
-                        await TopUpCore.add(
-                            user_pk=user_row.id,
-                            transaction_hash=i['transaction_id'],
-                            amount=transfer_amount,
-                            usdt_amount=get_rate('tether', transfer_amount),
-                            pre_value=pre_value,
-                            post_value=user_row.usdt_balance + transfer_amount
-                        )
+                        # The application, the balance and the top-up change in one transaction or not at all
+                        async with unit_of_work() as uow:
+                            # Only the check that removed the application credits it, an overlapping one waits
+                            # for the row lock and finds nothing left to delete
+                            if not await ActiveApplicationCore.delete(id=application_id):
+                                return
+
+                            try:
+                                balance = await UserCore.credit(
+                                    application_row.user_pk,
+                                    transfer_amount,
+                                    reason='topup',
+                                    ref=i['transaction_id'],
+                                )
+                            except IntegrityError as err:
+                                raise TopUpError(f'transfer {i["transaction_id"]} is already credited') from err
+                            if balance is None:
+                                raise TopUpError(f'user {application_row.user_pk} not found')
+                            await TopUpCore.add(
+                                user_id=application_row.user_pk,
+                                transaction_hash=i['transaction_id'],
+                                usdt_amount=transfer_amount,
+                                pre_balance=balance - Decimal(str(transfer_amount)),
+                            )
+                            await uow.commit()
+                        return
+
+# Counters of the expired TgAuthToken sweeps, printed after every sweep that deleted something
+token_reaper_stats = {'sweeps': 0, 'batches': 0, 'reaped': 0, 'last_sweep_reaped': 0, 'last_sweep_seconds': 0.0, 'errors': 0}
+
+
+async def reap_expired_tokens(interval: float = config.TG_TOKEN_REAP_INTERVAL, batch: int = config.TG_TOKEN_REAP_BATCH):
+    retention = timedelta(minutes=config.TG_TOKEN_RETENTION)
+    while True:
+        started = time.perf_counter()
+        reaped = 0
+        try:
+            while True:
+                deleted = await TgAuthTokenCore.delete_expired(batch, older_than=retention)
+                token_reaper_stats['batches'] += 1
+                reaped += deleted
+                if deleted < batch:
+                    break
+                # Let other coroutines in between batches of a large backlog
+                await asyncio.sleep(0)
+        except Exception as e:
+            token_reaper_stats['errors'] += 1
+            print(f'Token reaper failed: {e!r}')
+
+        token_reaper_stats['sweeps'] += 1
+        token_reaper_stats['reaped'] += reaped
+        token_reaper_stats['last_sweep_reaped'] = reaped
+        token_reaper_stats['last_sweep_seconds'] = time.perf_counter() - started
+        if reaped:
+            print(f'Token reaper: {reaped} expired tokens deleted in {token_reaper_stats["last_sweep_seconds"]:.3f}s, stats {token_reaper_stats}')
+
+        await asyncio.sleep(interval)
 
 async def get_rate(currency: Literal['rub', 'tether'], amount: float = 0) -> float:
     rate: float = 0